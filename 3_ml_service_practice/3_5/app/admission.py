@@ -0,0 +1,64 @@
+# =============================================
+# Контроль приёма ML-задач по длине очереди (сброс нагрузки до списания средств)
+# =============================================
+from fastapi import HTTPException, status
+from app.broker import get_task_queue_stats
+from metrics import metrics
+from config import get_settings
+import logging
+import math
+import time
+
+logger = logging.getLogger("uvicorn.error")
+
+
+async def get_queue_stats() -> tuple[int, int]:
+    """
+    Длина очереди задач и число подключённых воркеров.
+    Берутся из ответа на пассивное объявление очереди (get_task_queue_stats)
+    и кэшируются на ADMISSION_CHECK_INTERVAL_SECONDS, чтобы не нагружать брокер на каждый запрос.
+    """
+    settings = get_settings()
+    now = time.monotonic()
+    checked_at, stats = getattr(get_queue_stats, "_cached", (None, None))
+    if checked_at is not None and now - checked_at < settings.ADMISSION_CHECK_INTERVAL_SECONDS:
+        return stats
+    stats = await get_task_queue_stats()
+    get_queue_stats._cached = (now, stats)
+    metrics.set("ml_tasks_queue_depth", stats[0])
+    metrics.set("ml_tasks_consumers", stats[1])
+    return stats
+
+
+def _reject(detail: str, retry_after: float):
+    metrics.inc("admission_rejected")
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+async def admission_control():
+    """
+    Зависимость маршрутов запуска предсказаний: не принимает задачу (и не списывает за неё деньги),
+    если воркеры не успевают. Ожидаемое ожидание = длина очереди * ADMISSION_TASK_SECONDS / число воркеров.
+    Отказ - 503 с Retry-After и оценкой ожидания.
+    """
+    settings = get_settings()
+    try:
+        depth, consumers = await get_queue_stats()
+    except Exception as e:
+        # Без брокера задача всё равно не попадёт в очередь — не принимаем её до списания
+        logger.warning(f"Не удалось получить длину очереди задач: {e}")
+        _reject("Очередь задач недоступна, повторите попытку позже", settings.ADMISSION_CHECK_INTERVAL_SECONDS)
+
+    if consumers == 0:
+        _reject("Нет доступных воркеров, повторите попытку позже", settings.ADMISSION_MAX_WAIT_SECONDS)
+
+    expected_wait = depth * settings.ADMISSION_TASK_SECONDS / consumers
+    if depth >= settings.ADMISSION_MAX_QUEUE_DEPTH or expected_wait > settings.ADMISSION_MAX_WAIT_SECONDS:
+        _reject(
+            f"Сервис перегружен: в очереди {depth} задач, ожидание около {math.ceil(expected_wait)} с",
+            expected_wait - settings.ADMISSION_MAX_WAIT_SECONDS
+        )
@@ -4,15 +4,22 @@ from app.routers.user import user_router
 from app.routers.balance import balance_router
 from app.routers.ml_model import ml_model_router
 from app.routers.ml_task import ml_task_router
-from database.database import init_db
+from database.database import init_db, warm_up_pool, start_write_tracking, get_replica_engine, READ_YOUR_WRITES_COOKIE
+from app.crud.warmup import run_hot_queries
+from app.crud.cache import start_invalidation_listener
+from app.broker import close_connection
+from app.auth.access_token import refresh_expired_access_token, set_access_cookie, get_admin_user
+from database.instrumentation import start_query_stats
+from metrics import metrics
 from config import get_settings
 import uvicorn
 import logging
+import time
 from contextlib import asynccontextmanager
 import sys, os
 from fastapi.templating import Jinja2Templates
 from app.routers.web import web_router
-from fastapi import FastAPI, Request, HTTPException, status
+from fastapi import FastAPI, Request, HTTPException, status, Depends
 from fastapi.responses import JSONResponse, RedirectResponse
 # Добавляем текущую директорию в путь Python
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -36,10 +43,26 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"Ошибка при инициализации БД: {str(e)}")
         raise
+
+    # Прогрев: заранее открываем соединения пула и готовим горячие запросы,
+    # чтобы первые запросы нового пода не платили за установку соединений
+    try:
+        await warm_up_pool(run_hot_queries)
+        if get_replica_engine() is not None:
+            await warm_up_pool(run_hot_queries, engine=get_replica_engine())
+    except Exception as e:
+        logger.warning(f"Не удалось прогреть пул соединений: {str(e)}")
+
+    # Инвалидации кэшей от других реплик. Без брокера кэши всё равно работают, устаревая не дольше TTL
+    try:
+        await start_invalidation_listener()
+    except Exception as e:
+        logger.warning(f"Не удалось подписаться на инвалидации кэша: {str(e)}")
     yield
 
     # Закрытие
     logger.info("Приложение закрывается...")
+    await close_connection()
 
 
 def create_application() -> FastAPI:
@@ -63,6 +86,56 @@ def create_application() -> FastAPI:
         allow_headers=["*"],
     )
 
+    @app.middleware("http")
+    async def query_stats(request: Request, call_next):
+        """
+        Считает SQL-запросы каждого HTTP-запроса. В режиме DEBUG количество и время
+        запросов отдаются в заголовках ответа X-DB-Queries и X-DB-Time-Ms.
+        """
+        stats = start_query_stats()
+        response = await call_next(request)
+        route = request.scope.get("route")
+        metrics.observe("db_queries_per_request", stats["count"], route=getattr(route, "path", "unknown"))
+        if settings.DEBUG:
+            response.headers["X-DB-Queries"] = str(stats["count"])
+            response.headers["X-DB-Time-Ms"] = f"{stats['time'] * 1000:.1f}"
+        return response
+
+    @app.middleware("http")
+    async def read_your_writes(request: Request, call_next):
+        """
+        Если в запросе была запись в БД — ставим куку, по которой следующие чтения клиента
+        в течение READ_YOUR_WRITES_SECONDS пойдут в основную БД, а не в реплику.
+        """
+        state = start_write_tracking(request.cookies.get(READ_YOUR_WRITES_COOKIE))
+        response = await call_next(request)
+        if state["wrote"] and get_replica_engine() is not None:
+            response.set_cookie(
+                key=READ_YOUR_WRITES_COOKIE,
+                value=str(time.time()),
+                httponly=True,
+                samesite="lax",
+                max_age=settings.READ_YOUR_WRITES_SECONDS
+            )
+        return response
+
+    @app.middleware("http")
+    async def refresh_tokens(request: Request, call_next):
+        """
+        Истёкший access-токен прозрачно обновляется по refresh-токену: запрос авторизуется новым
+        токеном, а он же сохраняется в куки ответа.
+        """
+        token = await refresh_expired_access_token(request)
+        response = await call_next(request)
+        if token:
+            set_access_cookie(response, token)
+        return response
+
+    @app.get("/metrics", include_in_schema=False, dependencies=[Depends(get_admin_user)])
+    async def get_metrics():
+        """Метрики процесса: SQL-запросы, пул соединений и т.д. Только для администратора (сборщику - API-ключ администратора)"""
+        return metrics.snapshot()
+
     # Регистрация эндпоинтов
     app.include_router(user_router, prefix='/users', tags=['Пользователи'])
     app.include_router(balance_router, prefix='/balance', tags=['Баланс'])
@@ -103,7 +176,10 @@ if __name__ ==  '__main__':
         host='localhost',  # '0.0.0.0'
         port=8080,
         reload=True,
-        log_level="info"
+        log_level="info",
+        # адрес клиента из X-Forwarded-For от nginx, иначе все клиенты выглядят как один IP прокси
+        proxy_headers=True,
+        forwarded_allow_ips=settings.FORWARDED_ALLOW_IPS
     )
 
 
@@ -3,30 +3,63 @@ from config import get_settings
 from fastapi import HTTPException, status, Request, Depends
 from datetime import datetime, timezone, timedelta
 from fastapi import Response
+from fastapi.security import APIKeyHeader
 from app.crud.user import UserCRUD
-from database.database import get_session
-from sqlalchemy.ext.asyncio import AsyncSession
+from app.crud.api_key import ApiKeyCRUD
 from app.models.user import User
+from database.database import get_readonly_session, get_session_local, get_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.crud.schemas import CurrentUserSchema
+from app.models.enums import UserRole
+import logging
+
+logger = logging.getLogger("uvicorn.error")
 
 settings = get_settings()
 
-def create_token(user: str) -> str:
+ACCESS_TOKEN_COOKIE = "access_token"
+REFRESH_TOKEN_COOKIE = "refresh_token"
+
+# Машинные клиенты передают API-ключ в заголовке: "Authorization: Bearer mlk_..."
+api_key_sec = APIKeyHeader(name="Authorization", auto_error=False)
+
+
+def get_api_key(request: Request) -> str | None:
+    """API-ключ из заголовка Authorization (со схемой Bearer или без неё)"""
+    header = request.headers.get("Authorization")
+    if not header:
+        return None
+    scheme, _, value = header.partition(" ")
+    return value.strip() if scheme.lower() == "bearer" and value else header.strip()
+
+
+def create_token(user: User, token_type: str = "access") -> str:
     """
-    Создает JWT токен доступа для пользователя.
+    Создает JWT токен для пользователя.
+    access-токен короткоживущий и несёт всё, что нужно для авторизации (id, имя, email, роль),
+    поэтому запросы с ним не читают пользователя из БД. refresh-токен нужен только для выпуска новых access.
+    ver - версия токенов пользователя: после её увеличения старые токены не принимаются.
     """
     # Срок действия токена
-    expiration_time = datetime.now(timezone.utc) + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+    if token_type == "refresh":
+        lifetime = timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
+    else:
+        lifetime = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     payload = {
-        "sub": user,
-        "exp": expiration_time
+        "sub": str(user.user_id),
+        "type": token_type,
+        "ver": user.token_version,
+        "exp": datetime.now(timezone.utc) + lifetime
     }
+    if token_type == "access":
+        payload.update({"name": user.user_name, "email": user.email, "role": user.role.value})
     token = jwt.encode(payload, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return token
 
 
-def verify_token(token: str) -> dict:
+def verify_token(token: str, token_type: str = "access") -> dict:
     """
-    Проверяет валидность JWT токена.
+    Проверяет валидность JWT токена и его тип (access / refresh).
     HTTPException: Если токен недействителен или просрочен
     """
     #  Декодируем токен. PyJWT сам проверит поле "exp",
@@ -37,6 +70,8 @@ def verify_token(token: str) -> dict:
             settings.SECRET_KEY,
             algorithms=[settings.ALGORITHM]
         )
+        if data.get("type") != token_type:
+            raise jwt.InvalidTokenError("Неверный тип токена")
         return data
 
     except jwt.ExpiredSignatureError:
@@ -51,13 +86,12 @@ def verify_token(token: str) -> dict:
         )
 
 
-def set_token_cookie(response: Response, user_email: str):
+def set_access_cookie(response: Response, token: str):
     """
-    Сохранение токена в куки
+    Сохранение access-токена в куки
     """
-    token = create_token(user=user_email)
     response.set_cookie(
-        key="access_token",
+        key=ACCESS_TOKEN_COOKIE,
         value=token,
         httponly=True, #  JS не сможет украсть токен
         samesite="lax", #  защищает от CSRF-атак
@@ -65,39 +99,124 @@ def set_token_cookie(response: Response, user_email: str):
     )
 
 
-def delete_token_cookie(response: Response):
+def set_token_cookie(response: Response, user: User):
     """
-    Удаляет авторизационную куку из браузера пользователя.
+    Сохранение пары токенов (access и refresh) в куки
     """
-    response.delete_cookie(
-        key="access_token",
+    set_access_cookie(response, create_token(user))
+    response.set_cookie(
+        key=REFRESH_TOKEN_COOKIE,
+        value=create_token(user, token_type="refresh"),
         httponly=True,
-        samesite="lax"
+        samesite="lax",
+        max_age=settings.REFRESH_TOKEN_EXPIRE_DAYS * 24 * 60 * 60
     )
 
 
+def delete_token_cookie(response: Response):
+    """
+    Удаляет авторизационные куки из браузера пользователя.
+    """
+    for key in (ACCESS_TOKEN_COOKIE, REFRESH_TOKEN_COOKIE):
+        response.delete_cookie(
+            key=key,
+            httponly=True,
+            samesite="lax"
+        )
+
+
+async def refresh_access_token(db_session: AsyncSession, refresh_token: str) -> str:
+    """
+    Выпускает новый access-токен по refresh-токену.
+    Пользователь и версия токенов читаются из основной БД (без кэша): это редкий запрос,
+    и здесь важно сразу увидеть удаление пользователя или отзыв токенов.
+    HTTPException: Если refresh-токен недействителен или отозван
+    """
+    payload = verify_token(refresh_token, token_type="refresh")
+    user = await UserCRUD.get_by_id(db_session, int(payload["sub"]))
+    if user is None or user.token_version != payload.get("ver"):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Токен отозван"
+        )
+    return create_token(user)
+
+
+async def refresh_expired_access_token(request: Request) -> str | None:
+    """
+    Для middleware: если access-токен в куках отсутствует или истёк, а refresh-токен есть —
+    выпускает новый access-токен и кладёт его в request.state, чтобы им воспользовался get_optional_user.
+    Возвращает новый токен (его нужно сохранить в куки ответа) или None.
+    """
+    refresh_token = request.cookies.get(REFRESH_TOKEN_COOKIE)
+    if not refresh_token:
+        return None
+    access_token = request.cookies.get(ACCESS_TOKEN_COOKIE)
+    if access_token:
+        try:
+            verify_token(access_token)
+            return None
+        except HTTPException:
+            pass
+    try:
+        async with get_session_local()(bind=get_engine()) as db_session:
+            token = await refresh_access_token(db_session, refresh_token)
+    except HTTPException:
+        return None
+    except Exception as e:
+        logger.warning(f"Не удалось обновить access-токен: {e}")
+        return None
+    request.state.access_token = token
+    return token
+
+
 async def get_optional_user(
     request: Request,
-    db_session: AsyncSession = Depends(get_session)
-) -> User | None:
+    db_session: AsyncSession = Depends(get_readonly_session)
+) -> CurrentUserSchema | None:
     """
-    Тихая проверка наличия токена в куках: возвращает User, если кука верна, иначе None (без ошибок).
+    Тихая проверка наличия токена в куках: возвращает пользователя, если кука верна, иначе None (без ошибок).
+    Пользователь собирается из claims токена. Из БД (при промахе кэша) читается только версия токенов,
+    чтобы отозванные токены и удалённые пользователи не проходили.
+    Если передан заголовок Authorization — авторизация по API-ключу (тоже через кэш).
     """
-    token = request.cookies.get("access_token")
+    api_key = get_api_key(request)
+    if api_key:
+        try:
+            return await ApiKeyCRUD.get_user(db_session, api_key)
+        except Exception:
+            return None
+    token = getattr(request.state, "access_token", None) or request.cookies.get(ACCESS_TOKEN_COOKIE)
     if not token:
         return None
     try:
         payload = verify_token(token)
-        email = payload.get("sub")
-        return await UserCRUD.get_by_email(db_session, email)
+        user_id = int(payload["sub"])
+        if await UserCRUD.get_token_version(db_session, user_id) != payload.get("ver"):
+            return None
+        return CurrentUserSchema(
+            user_id=user_id,
+            user_name=payload["name"],
+            email=payload["email"],
+            role=payload["role"]
+        )
     except Exception:
         return None
 
 #
-async def get_current_user(user: User = Depends(get_optional_user)) -> User:
+async def get_current_user(user: CurrentUserSchema = Depends(get_optional_user)) -> CurrentUserSchema:
     """
     Проверка наличия токена в куках: возвращает User, если кука верна, иначе возвращает ошибку
     """
     if not user:
         raise HTTPException(status_code=401, detail="Вы не авторизованы")
+    return user
+
+
+async def get_admin_user(user: CurrentUserSchema = Depends(get_current_user)) -> CurrentUserSchema:
+    """
+    Доступ только администратору (по токену или API-ключу администратора), иначе 403
+    """
+    if user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Недостаточно прав")
     return user
\ No newline at end of file
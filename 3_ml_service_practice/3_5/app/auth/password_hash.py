@@ -1,22 +1,69 @@
 from passlib.context import CryptContext
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, status
+from config import get_settings
+from metrics import metrics
+import asyncio
+
+settings = get_settings()
+
+# Создаем контекст с использованием bcrypt алгоритма.
+# Стоимость задаётся BCRYPT_ROUNDS; хеши с другой стоимостью пересчитываются при входе (verify_and_update)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+# Отдельный пул для bcrypt: хеширование занимает 100-300 мс CPU и не должно блокировать event loop.
+# bcrypt отпускает GIL, поэтому потоков достаточно
+_executor = ThreadPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+# Сколько операций сейчас в пуле (выполняются и ждут очереди)
+_pending = 0
+
+
+async def _run(func, *args):
+    """
+    Выполняет func в пуле bcrypt. Если очередь уже заполнена — сразу отвечает 503 с Retry-After,
+    чтобы волна входов не копила задержку и не забирала CPU у остального API.
+    """
+    global _pending
+    if _pending >= settings.PASSWORD_HASH_MAX_PENDING:
+        metrics.inc("password_hash_rejected")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Сервис перегружен, повторите попытку позже",
+            headers={"Retry-After": str(settings.PASSWORD_HASH_RETRY_AFTER_SECONDS)}
+        )
+    _pending += 1
+    metrics.set("password_hash_pending", _pending)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+        metrics.set("password_hash_pending", _pending)
 
-# Создаем контекст с использованием bcrypt алгоритма
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 class PasswordHash:
     """
     Класс для хеширования и верификации паролей с использованием bcrypt.
+    Вычисления выполняются в ограниченном пуле потоков, а не в event loop.
     """
     @staticmethod
-    def create(password: str) -> str:
+    async def create(password: str) -> str:
         """
         Создает хеш из переданного пароля.
         """
-        return pwd_context.hash(password)
+        return await _run(pwd_context.hash, password)
 
     @staticmethod
-    def verify(password: str, password_hash: str) -> bool:
+    async def verify(password: str, password_hash: str) -> bool:
         """
         Проверяет соответствие пароля его хешу.
         """
-        return pwd_context.verify(password, password_hash)
\ No newline at end of file
+        return await _run(pwd_context.verify, password, password_hash)
+
+    @staticmethod
+    async def verify_and_update(password: str, password_hash: str) -> tuple[bool, str | None]:
+        """
+        Проверяет пароль и, если хеш создан с устаревшими параметрами (например, другой стоимостью),
+        возвращает новый хеш для сохранения. Иначе второй элемент - None.
+        """
+        return await _run(pwd_context.verify_and_update, password, password_hash)
@@ -0,0 +1,229 @@
+# =============================================
+# Общее подключение к RabbitMQ для процесса
+# =============================================
+from aio_pika import connect_robust, Message
+from aio_pika.abc import AbstractRobustConnection, AbstractChannel, AbstractQueue, AbstractIncomingMessage
+from app.task_payload import encode_task_payload
+from app.models.enums import UserRole
+from config import get_settings
+from datetime import datetime
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("uvicorn.error")
+
+# Очередь задач для ML-воркеров
+TASK_QUEUE = "ml_tasks"
+# Отложенные задачи пользователей, превысивших лимит задач в работе: ml_tasks.deferred.<N> держит сообщение
+# N-ю задержку из TASK_DEFER_DELAYS_MS и возвращает его в TASK_QUEUE (dead-letter). Чем чаще задачу
+# откладывали, тем дольше задержка: задачи пользователя с большой очередью не гоняются по кругу
+TASK_DEFERRED_QUEUE_PREFIX = "ml_tasks.deferred."
+# Повторы после ошибки: ml_tasks.retry.<N> держит сообщение N-ю задержку из TASK_RETRY_DELAYS_MS
+# и возвращает его в TASK_QUEUE. После последней попытки задача попадает в TASK_DEAD_QUEUE
+TASK_RETRY_QUEUE_PREFIX = "ml_tasks.retry."
+TASK_DEAD_QUEUE = "ml_tasks.dead"
+# Всё, что ml_tasks отбрасывает (истёк срок ожидания или сообщение отклонено воркером), попадает сюда.
+# Истёкшие задачи воркер пачками закрывает с возвратом средств, остальное переносит в TASK_DEAD_QUEUE
+TASK_EXPIRED_QUEUE = "ml_tasks.expired"
+# Заголовок сообщения с номером попытки (0 - первая)
+ATTEMPT_HEADER = "x-attempt"
+# Заголовок сообщения: сколько раз задачу уже откладывали
+DEFER_HEADER = "x-deferrals"
+
+_lock = asyncio.Lock()
+
+
+async def get_connection() -> AbstractRobustConnection:
+    """
+    Возвращает одно устойчивое подключение (с автоматическим переподключением) на процесс.
+    Создаётся при первом вызове.
+    """
+    if getattr(get_connection, "_connection", None) is None:
+        async with _lock:
+            if getattr(get_connection, "_connection", None) is None:
+                logger.info("Подключение к RabbitMQ...")
+                get_connection._connection = await connect_robust(get_settings().RABBITMQ_URL)
+    return get_connection._connection
+
+
+async def get_channel() -> AbstractChannel:
+    """
+    Возвращает общий канал процесса. Создаётся при первом вызове, после обрыва связи
+    восстанавливается вместе с подключением.
+    """
+    if getattr(get_channel, "_channel", None) is None:
+        connection = await get_connection()
+        async with _lock:
+            if getattr(get_channel, "_channel", None) is None:
+                get_channel._channel = await connection.channel()
+    return get_channel._channel
+
+
+async def declare_task_queue(channel: AbstractChannel) -> AbstractQueue:
+    """
+    Объявляет очередь задач. Параметры очереди должны совпадать у API и воркеров,
+    поэтому объявление только здесь.
+    Ответ на объявление (queue.declaration_result) содержит длину очереди и число потребителей.
+    """
+    # durable=True, чтобы очередь не пропала при перезагрузке;
+    # x-max-priority включает приоритеты сообщений (0..TASK_MAX_PRIORITY);
+    # истёкшие и отклонённые воркером сообщения уходят в TASK_EXPIRED_QUEUE, а не теряются
+    return await channel.declare_queue(
+        TASK_QUEUE,
+        durable=True,
+        arguments={
+            "x-max-priority": get_settings().TASK_MAX_PRIORITY,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": TASK_EXPIRED_QUEUE
+        }
+    )
+
+
+def get_defer_delays() -> list[int]:
+    """Задержки отложенных задач в миллисекундах, по одной на откладывание (последняя - для всех следующих)"""
+    return [int(delay) for delay in get_settings().TASK_DEFER_DELAYS_MS.split(",") if delay.strip()]
+
+
+async def get_task_queue_stats() -> tuple[int, int]:
+    """
+    Длина очереди задач и число подключённых воркеров - пассивным объявлением (без аргументов очереди):
+    если параметры очереди у брокера другие (например, изменили TASK_MAX_PRIORITY), повторное объявление
+    закрыло бы канал с PRECONDITION_FAILED. Отдельный канал: если очереди ещё нет, брокер закроет только его.
+    """
+    channel = getattr(get_task_queue_stats, "_channel", None)
+    if channel is None or channel.is_closed:
+        channel = get_task_queue_stats._channel = await (await get_connection()).channel()
+    queue = await channel.declare_queue(TASK_QUEUE, passive=True)
+    return queue.declaration_result.message_count, queue.declaration_result.consumer_count
+
+
+async def declare_deferred_queues(channel: AbstractChannel) -> list[str]:
+    """
+    Объявляет очереди отложенных задач (без потребителей, только задержка), по одной на задержку.
+    Возвращает имена очередей по возрастанию задержки.
+    """
+    names = []
+    for level, delay in enumerate(get_defer_delays()):
+        name = f"{TASK_DEFERRED_QUEUE_PREFIX}{level}"
+        await channel.declare_queue(
+            name,
+            durable=True,
+            arguments={
+                "x-message-ttl": delay,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": TASK_QUEUE
+            }
+        )
+        names.append(name)
+    return names
+
+
+def get_retry_delays() -> list[int]:
+    """Задержки повторов в миллисекундах, по одной на попытку"""
+    return [int(delay) for delay in get_settings().TASK_RETRY_DELAYS_MS.split(",") if delay.strip()]
+
+
+async def declare_retry_queues(channel: AbstractChannel) -> list[str]:
+    """
+    Объявляет очереди повторов (по одной на задержку) и очередь окончательно упавших задач.
+    Возвращает имена очередей повторов в порядке попыток.
+    """
+    names = []
+    for attempt, delay in enumerate(get_retry_delays()):
+        name = f"{TASK_RETRY_QUEUE_PREFIX}{attempt}"
+        await channel.declare_queue(
+            name,
+            durable=True,
+            arguments={
+                "x-message-ttl": delay,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": TASK_QUEUE
+            }
+        )
+        names.append(name)
+    await channel.declare_queue(TASK_DEAD_QUEUE, durable=True)
+    return names
+
+
+async def declare_expired_queue(channel: AbstractChannel) -> AbstractQueue:
+    """Объявляет очередь сообщений, отброшенных ml_tasks"""
+    return await channel.declare_queue(TASK_EXPIRED_QUEUE, durable=True)
+
+
+def get_task_priority(input_text: str, role: UserRole, requested: int | None = None) -> int:
+    """
+    Приоритет задачи в очереди (чем больше, тем раньше её заберёт воркер):
+    - TASK_MAX_PRIORITY - администраторы;
+    - 2 - короткие интерактивные запросы (не длиннее TASK_SHORT_INPUT_CHARS символов);
+    - 1 - остальные запросы.
+    Клиент может явно понизить приоритет (например, 0 для пакетной загрузки), но не повысить.
+    role - роль автора задачи.
+    """
+    settings = get_settings()
+    if role == UserRole.ADMIN:
+        priority = settings.TASK_MAX_PRIORITY
+    elif len(input_text) <= settings.TASK_SHORT_INPUT_CHARS:
+        priority = 2
+    else:
+        priority = 1
+    if requested is not None:
+        priority = min(priority, requested)
+    return priority
+
+
+async def publish_task(
+        task_id: int,
+        input_text: str,
+        model_id: int,
+        priority: int = 1,
+        user_id: int | None = None,
+        sla_seconds: int | None = None,
+        created_at: datetime | None = None
+):
+    """
+    Публикует задачу в очередь ml_tasks (из API и при возврате задачи в очередь воркером).
+    Если задан sla_seconds, сообщение истекает, если его не взяли за это время.
+    При повторной публикации уже созданной задачи передайте created_at: срок считается от создания задачи,
+    и повторная публикация его не продлевает (задача с истёкшим сроком сразу уйдёт на возврат средств).
+    Формат тела - TASK_PAYLOAD_FORMAT (см. app.task_payload).
+    """
+    enqueued_at_ns = time.time_ns()
+    # срок нужен и в теле: при откладывании и повторах сообщение копируется, и expiration начинается заново
+    expires_at_ns, expiration = None, None
+    if sla_seconds:
+        started_ns = int(created_at.timestamp() * 1e9) if created_at else enqueued_at_ns
+        expires_at_ns = started_ns + sla_seconds * 1_000_000_000
+        expiration = max(expires_at_ns - enqueued_at_ns, 0) / 1e9
+    # user_id - для лимита задач пользователя в работе
+    body, content_type = encode_task_payload(
+        task_id, input_text, model_id, priority, user_id, enqueued_at_ns, expires_at_ns,
+        payload_format=get_settings().TASK_PAYLOAD_FORMAT
+    )
+    channel = await get_channel()
+    await channel.default_exchange.publish(
+        Message(body, content_type=content_type, priority=priority, expiration=expiration),
+        routing_key=TASK_QUEUE
+    )
+
+
+def copy_message(message: AbstractIncomingMessage, headers: dict | None = None) -> Message:
+    """
+    Копия сообщения задачи для пересылки в другую очередь: тело, формат (content_type), приоритет
+    и заголовки (или headers вместо них).
+    """
+    return Message(
+        message.body,
+        content_type=message.content_type,
+        priority=message.priority,
+        headers=message.headers if headers is None else headers
+    )
+
+
+async def close_connection():
+    """Закрывает общее подключение (при остановке приложения)"""
+    connection = getattr(get_connection, "_connection", None)
+    get_channel._channel = None
+    get_connection._connection = None
+    if connection is not None:
+        await connection.close()
@@ -0,0 +1,118 @@
+# =============================================
+# Функции с API-ключами для использования в эндпоинтах
+# =============================================
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, lambda_stmt
+from app.models.api_key import ApiKey
+from app.models.user import User
+from app.crud.schemas import CurrentUserSchema
+from app.crud.cache import TTLCache, invalidate
+from app.crud.user import UserCRUD
+from database.database import get_session_local, get_engine, get_replica_engine
+from config import get_settings
+import hashlib
+import logging
+import secrets
+
+logger = logging.getLogger("uvicorn.error")
+
+settings = get_settings()
+
+# Префикс, по которому ключ легко узнать (например, при поиске утечек в логах и репозиториях)
+API_KEY_PREFIX = "mlk_"
+
+# Кэш ключей: SHA-256 ключа -> владелец действующего ключа
+api_key_cache = TTLCache("api_keys", maxsize=settings.API_KEY_CACHE_MAX_SIZE, ttl=settings.API_KEY_CACHE_TTL_SECONDS)
+
+# Неизвестные и отозванные ключи - в отдельном маленьком кэше с коротким TTL:
+# поток случайных ключей вытесняет только такие же записи, а не действующие ключи
+api_key_miss_cache = TTLCache(
+    "api_key_misses", maxsize=settings.API_KEY_MISS_CACHE_MAX_SIZE, ttl=settings.API_KEY_MISS_CACHE_TTL_SECONDS
+)
+
+
+async def _find_key_owner(db_session: AsyncSession, key_hash: str):
+    """Владелец действующего ключа по уникальному индексу key_hash (строка) или None"""
+    result = await db_session.execute(
+        lambda_stmt(lambda: select(User.user_id, User.user_name, User.email, User.role)
+                    .join(ApiKey, ApiKey.user_id == User.user_id)
+                    .where(ApiKey.key_hash == key_hash, ApiKey.is_revoked == False))
+    )
+    return result.one_or_none()
+
+
+def hash_api_key(key: str) -> str:
+    """
+    SHA-256 от ключа. У ключа 256 бит случайности, поэтому медленный хеш (bcrypt) не нужен:
+    перебор невозможен, а поиск по уникальному индексу занимает микросекунды.
+    """
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class ApiKeyCRUD:
+    @staticmethod
+    async def create(db_session: AsyncSession, user_id: int, name: str) -> tuple[ApiKey, str]:
+        """
+        Создает ключ пользователю. Возвращает запись и сам ключ (его больше нигде не получить).
+        """
+        key = API_KEY_PREFIX + secrets.token_urlsafe(32)
+        api_key = ApiKey(user_id=user_id, name=name, key_hash=hash_api_key(key), prefix=key[:12])
+        db_session.add(api_key)
+        await db_session.commit()
+        await db_session.refresh(api_key)
+        logger.info(f"Пользователю {user_id} создан API-ключ {api_key.key_id}")
+        return api_key, key
+
+    @staticmethod
+    async def get_user_keys(db_session: AsyncSession, user_id: int):
+        """Действующие ключи пользователя"""
+        result = await db_session.execute(
+            lambda_stmt(lambda: select(ApiKey).where(ApiKey.user_id == user_id, ApiKey.is_revoked == False)
+                        .order_by(ApiKey.key_id))
+        )
+        return result.scalars().all()
+
+    @staticmethod
+    async def get_user(db_session: AsyncSession, key: str) -> CurrentUserSchema | None:
+        """
+        Владелец действующего ключа для авторизации. Ключ ищется в кэше, при промахе - по уникальному
+        индексу key_hash. Удаление пользователя проверяется через (кэшированную) версию токенов.
+        Неизвестный ключ перед записью в кэш промахов перепроверяется в основной БД: сессия чтения
+        может смотреть на отстающую реплику, где только что созданного ключа ещё нет.
+        """
+        key_hash = hash_api_key(key)
+        user = api_key_cache.get(key_hash)
+        if user is None:
+            if api_key_miss_cache.get(key_hash):
+                return None
+            row = await _find_key_owner(db_session, key_hash)
+            if row is None and get_replica_engine() is not None:
+                async with get_session_local()(bind=get_engine()) as primary_session:
+                    row = await _find_key_owner(primary_session, key_hash)
+            if row is None:
+                api_key_miss_cache.set(key_hash, True)
+                return None
+            user = CurrentUserSchema.model_construct(**row._asdict())
+            api_key_cache.set(key_hash, user)
+        if await UserCRUD.get_token_version(db_session, user.user_id) is None:
+            return None
+        return user
+
+    @staticmethod
+    async def revoke(db_session: AsyncSession, user_id: int, key_id: int) -> bool:
+        """
+        Отзывает ключ пользователя. Возвращает False, если ключ не найден.
+        """
+        result = await db_session.execute(
+            lambda_stmt(lambda: select(ApiKey).where(ApiKey.key_id == key_id, ApiKey.user_id == user_id,
+                                                     ApiKey.is_revoked == False))
+        )
+        api_key = result.scalar_one_or_none()
+        if api_key is None:
+            return False
+        api_key.is_revoked = True
+        await db_session.commit()
+        # Отозванный ключ должен перестать работать сразу на всех репликах
+        await invalidate(api_key_cache.name, api_key.key_hash)
+        logger.info(f"API-ключ {key_id} пользователя {user_id} отозван")
+        return True
@@ -8,12 +8,20 @@ from app.crud.user import UserCRUD
 from decimal import Decimal
 from app.models.transaction import Transaction
 from app.models.enums import TransactionType
-from sqlalchemy import select
+from app.crud.schemas import BalanceCurrentSchema
+from app.crud.cache import TTLCache, invalidate
+from sqlalchemy import select, lambda_stmt
+from config import get_settings
 import logging
 
 
 logger = logging.getLogger("uvicorn.error")
 
+settings = get_settings()
+
+# Кэш балансов для отображения (ключ - user_id). Списания всегда читают баланс из БД.
+balance_cache = TTLCache("balances", maxsize=settings.BALANCE_CACHE_MAX_SIZE, ttl=settings.BALANCE_CACHE_TTL_SECONDS)
+
 
 class BalanceCRUD:
     @staticmethod
@@ -30,19 +38,35 @@ class BalanceCRUD:
             return None
         # 4. Если мы здесь, значит пользователь активен. Спокойно берем баланс.
         result = await db_session.execute(
-            select(Balance).where(Balance.user_id == user_id)
+            lambda_stmt(lambda: select(Balance).where(Balance.user_id == user_id))
         )
         return result.scalar_one_or_none()
 
+    @staticmethod
     async def get_any(db_session: AsyncSession, user_id: int) -> Balance | None:
         """
         Получение баланса любого пользователя, в том числе удаленного.
         """
         result = await db_session.execute(
-            select(Balance).where(Balance.user_id == user_id)
+            lambda_stmt(lambda: select(Balance).where(Balance.user_id == user_id))
         )
         return result.scalar_one_or_none()
 
+    @staticmethod
+    async def get_cached(db_session: AsyncSession, user_id: int) -> BalanceCurrentSchema | None:
+        """
+        Баланс любого пользователя для отображения: из кэша, при промахе — из БД.
+        """
+        cached = balance_cache.get(user_id)
+        if cached is not None:
+            return cached
+        balance = await BalanceCRUD.get_any(db_session, user_id)
+        if not balance:
+            return None
+        cached = BalanceCurrentSchema.model_construct(amount=balance.amount)
+        balance_cache.set(user_id, cached)
+        return cached
+
     @staticmethod
     async def top_up(db_session: AsyncSession, user_id: int, top_up_amount: Decimal) -> Balance:
         """
@@ -71,6 +95,7 @@ class BalanceCRUD:
         db_session.add(new_transaction)
         await db_session.commit()
         await db_session.refresh(balance)
+        await invalidate(balance_cache.name, user_id)
         logger.info(f"Пополнение: {top_up_amount}, текущий баланс: {balance.amount}. Id пользователя {user_id}.")
         return balance
 
@@ -80,8 +105,8 @@ class BalanceCRUD:
         История транзакций пользователя
         """
         result = await db_session.execute(
-            select(Transaction)
-            .where(Transaction.user_id == user_id)
-            .order_by(Transaction.created_at.desc())
+            lambda_stmt(lambda: select(Transaction)
+                        .where(Transaction.user_id == user_id)
+                        .order_by(Transaction.created_at.desc()))
         )
         return result.scalars().all()
\ No newline at end of file
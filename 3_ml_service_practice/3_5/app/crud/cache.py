@@ -0,0 +1,136 @@
+# =============================================
+# Кэш в памяти процесса для часто читаемых данных
+# и рассылка инвалидаций между репликами через RabbitMQ
+# =============================================
+from collections import OrderedDict
+from aio_pika import ExchangeType, Message, IncomingMessage
+from app.broker import get_connection, get_channel
+from metrics import metrics
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+logger = logging.getLogger("uvicorn.error")
+
+# fanout: каждое сообщение получает каждая реплика
+CACHE_INVALIDATION_EXCHANGE = "cache_invalidation"
+
+# Сколько ждать брокер при рассылке инвалидации, чтобы недоступный брокер не тормозил запись
+PUBLISH_TIMEOUT_SECONDS = 1.0
+
+# Идентификатор процесса, чтобы не применять повторно собственные инвалидации
+INSTANCE_ID = uuid.uuid4().hex
+
+# Все кэши процесса по имени
+_caches: dict = {}
+
+
+class TTLCache:
+    """
+    Ограниченный по размеру кэш с временем жизни записей (первый уровень, в памяти реплики).
+    При переполнении вытесняется запись, которую дольше всех не читали (LRU).
+    Попадания и промахи считаются в метриках cache_hits / cache_misses с меткой cache=name.
+    Изменения данных нужно сообщать через invalidate(name, ...), а не delete, чтобы узнали все реплики.
+    """
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # ключ -> (момент устаревания, значение)
+        _caches[name] = self
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            metrics.inc("cache_misses", cache=self.name)
+            return default
+        self._data.move_to_end(key)
+        metrics.inc("cache_hits", cache=self.name)
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        metrics.set("cache_size", len(self._data), cache=self.name)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+def _invalidate_local(name: str, keys: list):
+    """Удаляет ключи из кэша процесса, без ключей — очищает кэш целиком"""
+    cache = _caches.get(name)
+    if cache is None:
+        return
+    if not keys:
+        cache.clear()
+    for key in keys:
+        cache.delete(key)
+
+
+async def _get_exchange():
+    if getattr(_get_exchange, "_exchange", None) is None:
+        channel = await get_channel()
+        _get_exchange._exchange = await channel.declare_exchange(CACHE_INVALIDATION_EXCHANGE, ExchangeType.FANOUT)
+    return _get_exchange._exchange
+
+
+async def invalidate(name: str, *keys):
+    """
+    Инвалидация после записи: сразу удаляет ключи (или весь кэш, если ключи не переданы)
+    в этом процессе и рассылает сообщение остальным репликам.
+    Ошибка брокера не ломает запись: другие реплики увидят изменения не позже TTL.
+    """
+    _invalidate_local(name, list(keys))
+    body = json.dumps({"origin": INSTANCE_ID, "cache": name, "keys": list(keys)}, default=str)
+
+    async def publish():
+        exchange = await _get_exchange()
+        await exchange.publish(Message(body.encode(), content_type="application/json"), routing_key="")
+
+    try:
+        await asyncio.wait_for(publish(), timeout=PUBLISH_TIMEOUT_SECONDS)
+        metrics.inc("cache_invalidations_sent", cache=name)
+    except Exception as e:
+        logger.warning(f"Не удалось разослать инвалидацию кэша {name}: {e}")
+
+
+async def _on_invalidation(message: IncomingMessage):
+    data = json.loads(message.body)
+    if data["origin"] == INSTANCE_ID:
+        return
+    # JSON превращает кортежи-ключи в списки — возвращаем обратно
+    keys = [tuple(key) if isinstance(key, list) else key for key in data["keys"]]
+    _invalidate_local(data["cache"], keys)
+    metrics.inc("cache_invalidations_received", cache=data["cache"])
+
+
+def _clear_all_caches(*args):
+    """После обрыва связи с брокером часть инвалидаций могла потеряться — начинаем с чистого кэша"""
+    logger.warning("Переподключение к RabbitMQ: кэши процесса очищены")
+    for cache in _caches.values():
+        cache.clear()
+
+
+async def start_invalidation_listener():
+    """
+    Подписывает процесс на инвалидации других реплик: у каждой реплики своя временная очередь,
+    привязанная к fanout-обменнику.
+    """
+    connection = await get_connection()
+    connection.reconnect_callbacks.add(_clear_all_caches)
+    channel = await connection.channel()
+    exchange = await channel.declare_exchange(CACHE_INVALIDATION_EXCHANGE, ExchangeType.FANOUT)
+    queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+    await queue.bind(exchange)
+    await queue.consume(_on_invalidation, no_ack=True)
+    logger.info("Подписка на инвалидации кэша запущена")
@@ -2,9 +2,62 @@
 # Функции с Ml моделями для использования в эндпоинтах
 # =============================================
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, lambda_stmt
 from app.models.ml_model import MLModel
-from app.crud.schemas import MLModelCreateSchema
+from app.crud.schemas import MLModelCreateSchema, MLModelReadSchema
+from app.crud.cache import TTLCache, invalidate
+from config import get_settings
+import asyncio
+
+
+class MLModelCache:
+    """
+    Кэш каталога ML-моделей в памяти процесса: таблица models меняется очень редко,
+    а модель нужна почти каждому запросу (predict, профиль). Обновляется раз в MODEL_CACHE_TTL_SECONDS
+    или сразу после изменения каталога на любой реплике (invalidate). Хранит схемы, а не ORM-объекты,
+    чтобы кэш не был привязан к сессии, в которой модели загружены.
+    """
+    _cache = TTLCache("models", maxsize=1, ttl=get_settings().MODEL_CACHE_TTL_SECONDS)
+    _lock = asyncio.Lock()
+
+    @classmethod
+    async def get_models(cls, db_session: AsyncSession) -> list[MLModelReadSchema]:
+        """Список моделей (по возрастанию id) из кэша, при необходимости загружает его из БД"""
+        models = cls._cache.get("catalog")
+        if models is not None:
+            return models
+        # Один запрос в БД на обновление, остальные ждут его результат
+        async with cls._lock:
+            models = cls._cache.get("catalog")
+            if models is None:
+                result = await db_session.execute(lambda_stmt(lambda: select(MLModel).order_by(MLModel.model_id)))
+                # model_construct без повторной валидации: данные уже из БД
+                models = [
+                    MLModelReadSchema.model_construct(
+                        model_id=model.model_id,
+                        model_name=model.model_name,
+                        cost_per_prediction=model.cost_per_prediction,
+                        description=model.description,
+                        sla_seconds=model.sla_seconds
+                    )
+                    for model in result.scalars().all()
+                ]
+                cls._cache.set("catalog", models)
+        return models
+
+    @classmethod
+    async def get_model(cls, db_session: AsyncSession, model_id: int) -> MLModelReadSchema | None:
+        """Модель по id из кэша"""
+        for model in await cls.get_models(db_session):
+            if model.model_id == model_id:
+                return model
+        return None
+
+    @classmethod
+    async def invalidate(cls):
+        """Сбрасывает кэш на всех репликах: следующий запрос загрузит каталог заново"""
+        await invalidate(cls._cache.name)
+
 
 class MLModelCRUD:
     @staticmethod
@@ -15,11 +68,14 @@ class MLModelCRUD:
         new_model = MLModel(
             model_name=model_data.model_name,
             cost_per_prediction=model_data.cost_per_prediction,
-            description=model_data.description
+            description=model_data.description,
+            sla_seconds=model_data.sla_seconds
         )
         db_session.add(new_model)
         await db_session.commit()
         await db_session.refresh(new_model)
+        # каталог изменился — кэш моделей больше не актуален
+        await MLModelCache.invalidate()
         return new_model
 
     @staticmethod
@@ -27,26 +83,32 @@ class MLModelCRUD:
         """
         Получение модели по id
         """
-        result = await db_session.execute(select(MLModel).where(MLModel.model_id == model_id))
+        result = await db_session.execute(lambda_stmt(lambda: select(MLModel).where(MLModel.model_id == model_id)))
         return result.scalar_one_or_none()
 
 
     @staticmethod
-    async def get_all(db_session: AsyncSession):
+    async def get_all(db_session: AsyncSession) -> list[MLModelReadSchema]:
+        """
+        Получение списка всех ML моделей (из кэша каталога)
+        """
+        return await MLModelCache.get_models(db_session)
+
+    @staticmethod
+    async def get_cached(db_session: AsyncSession, model_id: int) -> MLModelReadSchema | None:
         """
-        Получение списка всех ML моделей из БД
+        Получение модели по id из кэша каталога (без запроса в БД, пока кэш свежий)
         """
-        result = await db_session.execute(select(MLModel))
-        return result.scalars().all()
+        return await MLModelCache.get_model(db_session, model_id)
 
     @staticmethod
-    async def get_first_model(db_session: AsyncSession) -> MLModel:
+    async def get_first_model(db_session: AsyncSession) -> MLModelReadSchema:
         """
-        Получает первую доступную ML-модель из базы данных.
+        Получает первую доступную ML-модель (из кэша каталога).
         Если моделей нет — выбрасывает ошибку.
         """
-        result = await db_session.execute(select(MLModel).limit(1))
-        model = result.scalar_one_or_none()
+        models = await MLModelCache.get_models(db_session)
+        model = models[0] if models else None
         if not model:
             raise ValueError("В базе данных не найдено ни одной ML-модели. Сначала добавьте модель.")
         return model
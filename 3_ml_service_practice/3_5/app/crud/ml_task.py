@@ -1,14 +1,32 @@
 # =============================================
 # Функции с ML тасками для использования в эндпоинтах
 # =============================================
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, insert, func, lambda_stmt
+from sqlalchemy.exc import IntegrityError
+from collections import defaultdict
 from app.models.balance import Balance
 from app.models.transaction import Transaction
 from app.models.ml_model import MLModel
 from app.models.ml_task import MLTask
+from app.models.user import User
+from app.crud.ml_model import MLModelCRUD
+from app.crud.cache import TTLCache, invalidate
 from app.models.enums import TransactionType,TaskStatus
+from config import get_settings
+import logging
+
+logger = logging.getLogger("uvicorn.error")
+
+settings = get_settings()
+
+# Недавние ключи идемпотентности: (user_id, ключ) -> (task_id, входной текст).
+# Связка ключа с задачей не меняется, поэтому инвалидация между репликами не нужна
+idempotency_cache = TTLCache(
+    "idempotency_keys", maxsize=settings.IDEMPOTENCY_CACHE_MAX_SIZE, ttl=settings.IDEMPOTENCY_CACHE_TTL_SECONDS
+)
 
 
 class MLTaskCRUD:
@@ -17,19 +35,23 @@ class MLTaskCRUD:
             db_session: AsyncSession,
             user_id: int,
             model_id: int,
-            input_data: str
+            input_data: str,
+            idempotency_key: str | None = None
     ) -> MLTask:
         """
         Инициализация задачи: проверка баланса, списание средств.
+        Если задача с таким idempotency_key у пользователя уже есть, flush упадёт с IntegrityError
+        (уникальный индекс) до списания — используйте get_or_create.
         """
-        # 1. Получаем модель и её стоимость
-        model_result = await db_session.execute(select(MLModel).where(MLModel.model_id == model_id))
-        ml_model = model_result.scalar_one_or_none()
+        # 1. Получаем модель и её стоимость (из кэша каталога моделей, без запроса в БД)
+        ml_model = await MLModelCRUD.get_cached(db_session, model_id)
         if not ml_model:
             raise ValueError("Модель не найдена")
 
         # 2. Проверяем баланс пользователя
-        balance_result = await db_session.execute(select(Balance).where(Balance.user_id == user_id))
+        balance_result = await db_session.execute(
+            lambda_stmt(lambda: select(Balance).where(Balance.user_id == user_id))
+        )
         balance = balance_result.scalar_one_or_none()
 
         if not balance or balance.amount < ml_model.cost_per_prediction:
@@ -44,7 +66,8 @@ class MLTaskCRUD:
             model_id=model_id,
             input_data=input_data,
             status=TaskStatus.WAITING,
-            created_at=datetime.now()
+            created_at=datetime.now(),
+            idempotency_key=idempotency_key
         )
         db_session.add(new_task)
         await db_session.flush()  # Чтобы получить task_id для транзакции
@@ -60,8 +83,205 @@ class MLTaskCRUD:
 
         await db_session.commit()
         await db_session.refresh(new_task)
+        # баланс изменился — сбрасываем его кэш на всех репликах
+        await invalidate("balances", user_id)
+        if idempotency_key is not None:
+            idempotency_cache.set((user_id, idempotency_key), (new_task.task_id, input_data))
         return new_task
 
+    @staticmethod
+    async def find_by_idempotency_key(
+            db_session: AsyncSession,
+            user_id: int,
+            idempotency_key: str
+    ) -> tuple[int, str] | None:
+        """
+        Задача, созданная пользователем с этим ключом: (task_id, входной текст) или None.
+        Недавние ключи берутся из кэша процесса, остальные - по уникальному индексу (user_id, idempotency_key).
+        """
+        cached = idempotency_cache.get((user_id, idempotency_key))
+        if cached is not None:
+            return cached
+        result = await db_session.execute(
+            lambda_stmt(lambda: select(MLTask.task_id, MLTask.input_data)
+                        .where(MLTask.user_id == user_id, MLTask.idempotency_key == idempotency_key))
+        )
+        row = result.one_or_none()
+        if row is None:
+            return None
+        idempotency_cache.set((user_id, idempotency_key), tuple(row))
+        return tuple(row)
+
+    @staticmethod
+    async def get_or_create(
+            db_session: AsyncSession,
+            user_id: int,
+            model_id: int,
+            input_data: str,
+            idempotency_key: str
+    ) -> tuple[int, bool]:
+        """
+        Идемпотентное создание задачи: повтор запроса с тем же ключом возвращает исходную задачу
+        без второго списания. Возвращает (task_id, создана ли задача сейчас).
+        Если два повтора пришли одновременно, второй упрётся в уникальный индекс — его транзакция
+        (вместе со списанием) откатывается, и он получает задачу первого.
+        Ключ, уже использованный с другим текстом, - ошибка (ValueError).
+        """
+        existing = await MLTaskCRUD.find_by_idempotency_key(db_session, user_id, idempotency_key)
+        if existing is None:
+            try:
+                task = await MLTaskCRUD.create(db_session, user_id, model_id, input_data, idempotency_key)
+                return task.task_id, True
+            except IntegrityError:
+                await db_session.rollback()
+                existing = await MLTaskCRUD.find_by_idempotency_key(db_session, user_id, idempotency_key)
+                if existing is None:
+                    raise
+        task_id, original_input = existing
+        if original_input != input_data:
+            raise ValueError("Idempotency-Key уже использован для другого запроса")
+        return task_id, False
+
+    @staticmethod
+    async def claim(
+            db_session: AsyncSession,
+            task_id: int,
+            user_id: int | None,
+            max_in_flight: int,
+            is_retry: bool = False,
+            worker_id: str | None = None,
+            lease_seconds: int = 60
+    ) -> bool:
+        """
+        Воркер забирает задачу: WAITING -> IN_PROGRESS одним условным UPDATE, только если у пользователя
+        сейчас в работе меньше max_in_flight задач. Возвращает False, если задача не взята
+        (лимит пользователя исчерпан или задача уже не в статусе WAITING).
+        Повтор (is_retry) может забрать и задачу в IN_PROGRESS: статус мог не вернуться в WAITING,
+        если после ошибки не было связи с БД.
+        Блокировка по user_id (до конца транзакции) не даёт двум воркерам одновременно превысить лимит.
+        Задача берётся в аренду воркеру worker_id на lease_seconds (продлевается через heartbeat).
+        Коммит делает воркер.
+        """
+        statuses = [TaskStatus.WAITING, TaskStatus.IN_PROGRESS] if is_retry else [TaskStatus.WAITING]
+        query = update(MLTask).where(MLTask.task_id == task_id, MLTask.status.in_(statuses))
+        if user_id is not None:
+            await db_session.execute(select(func.pg_advisory_xact_lock(user_id)))
+            in_flight = (
+                select(func.count())
+                .select_from(MLTask)
+                .where(MLTask.user_id == user_id, MLTask.status == TaskStatus.IN_PROGRESS, MLTask.task_id != task_id)
+                .scalar_subquery()
+            )
+            query = query.where(in_flight < max_in_flight)
+        result = await db_session.execute(
+            query.values(
+                status=TaskStatus.IN_PROGRESS,
+                worker_id=worker_id,
+                lease_expires_at=datetime.now() + timedelta(seconds=lease_seconds)
+            ).returning(MLTask.task_id)
+        )
+        return result.scalar_one_or_none() is not None
+
+    @staticmethod
+    async def heartbeat(db_session: AsyncSession, task_id: int, worker_id: str, lease_seconds: int) -> bool:
+        """
+        Продлевает аренду задачи воркером. Возвращает False, если задачу у воркера уже забрали.
+        Коммит делает воркер.
+        """
+        result = await db_session.execute(
+            update(MLTask)
+            .where(MLTask.task_id == task_id, MLTask.worker_id == worker_id, MLTask.status == TaskStatus.IN_PROGRESS)
+            .values(lease_expires_at=datetime.now() + timedelta(seconds=lease_seconds))
+            .returning(MLTask.task_id)
+        )
+        return result.scalar_one_or_none() is not None
+
+    @staticmethod
+    async def reclaim_expired_leases(db_session: AsyncSession, max_reclaims: int) -> tuple[list, list[int]]:
+        """
+        Забирает задачи с истёкшей арендой (воркер умер или завис).
+        Задачи, которые забирали меньше max_reclaims раз, одним UPDATE возвращаются в WAITING —
+        их нужно снова опубликовать в очередь (возвращаются строки task_id, user_id, model_id, input_data,
+        created_at, lease_expires_at и role - роль автора для приоритета).
+        Для остальных возвращаются id — за них нужно вернуть деньги (refund_many).
+        Коммит делает вызывающий после публикации задач: если публикация не удалась, откат оставит
+        задачи с истёкшей арендой, и следующий запуск попробует снова.
+        """
+        now = datetime.now()
+        expired = (MLTask.status == TaskStatus.IN_PROGRESS, MLTask.lease_expires_at < now)
+        result = await db_session.execute(
+            update(MLTask)
+            .where(*expired, MLTask.reclaim_count < max_reclaims)
+            .values(
+                status=TaskStatus.WAITING,
+                worker_id=None,
+                # lease_expires_at не сбрасываем: RETURNING отдаёт значения после UPDATE,
+                # а по старому сроку считается время восстановления задачи
+                reclaim_count=MLTask.reclaim_count + 1
+            )
+            .returning(
+                MLTask.task_id, MLTask.user_id, MLTask.model_id, MLTask.input_data, MLTask.created_at,
+                MLTask.lease_expires_at,
+                select(User.role).where(User.user_id == MLTask.user_id).scalar_subquery().label("role")
+            )
+            .execution_options(synchronize_session=False)
+        )
+        requeued = result.all()
+
+        exhausted = await db_session.execute(
+            select(MLTask.task_id).where(*expired, MLTask.reclaim_count >= max_reclaims)
+        )
+        return requeued, list(exhausted.scalars().all())
+
+    @staticmethod
+    async def release(db_session: AsyncSession, task_id: int):
+        """
+        Возвращает задачу из работы в ожидание (IN_PROGRESS -> WAITING) перед повтором.
+        """
+        await db_session.execute(
+            update(MLTask)
+            .where(MLTask.task_id == task_id, MLTask.status == TaskStatus.IN_PROGRESS)
+            .values(status=TaskStatus.WAITING, worker_id=None, lease_expires_at=None)
+        )
+        await db_session.commit()
+
+    @staticmethod
+    async def requeue(db_session: AsyncSession, task_id: int) -> bool:
+        """
+        Подготавливает задачу из очереди упавших к повторному запуску (команда replay):
+        если за задачу уже вернули деньги (в каком бы статусе она ни была), списываем стоимость снова,
+        затем статус WAITING. Отменённую пользователем задачу не перезапускаем.
+        Возвращает False, если задача не найдена, выполнена, отменена или у пользователя не хватает средств.
+        """
+        task = await MLTaskCRUD.get_by_id(db_session, task_id)
+        if task is None or task.status in (TaskStatus.COMPLETED, TaskStatus.CANCELLED):
+            return False
+
+        # Деньги вернули, если списания и возвраты по задаче в сумме не меньше нуля
+        charged = await db_session.execute(
+            select(func.coalesce(func.sum(Transaction.amount), 0)).where(Transaction.related_task_id == task_id)
+        )
+        if charged.scalar_one() >= 0:
+            ml_model = await MLModelCRUD.get_cached(db_session, task.model_id)
+            balance_result = await db_session.execute(select(Balance).where(Balance.user_id == task.user_id))
+            balance = balance_result.scalar_one_or_none()
+            if ml_model is None or balance is None or balance.amount < ml_model.cost_per_prediction:
+                return False
+            balance.amount -= ml_model.cost_per_prediction
+            db_session.add(Transaction(
+                user_id=task.user_id,
+                amount=-ml_model.cost_per_prediction,
+                transaction_type=TransactionType.SPEND,
+                description=f"Повторное списание средств за задачу № {task.task_id}",
+                related_task_id=task.task_id
+            ))
+
+        task.status = TaskStatus.WAITING
+        task.prediction_result = None
+        await db_session.commit()
+        await invalidate("balances", task.user_id)
+        return True
+
     @staticmethod
     async def update_status(db_session: AsyncSession, task_id: int, status: TaskStatus):
         """
@@ -85,46 +305,134 @@ class MLTaskCRUD:
             task.status = TaskStatus.COMPLETED
             task.prediction_result = result_data
             task.completed_at = datetime.now()
+            task.lease_expires_at = None
 
-
-
+    @staticmethod
+    async def complete_many(db_session: AsyncSession, task_ids: list[int], result_data: str, worker_id: str) -> int:
+        """
+        Завершение сразу нескольких задач с одинаковым результатом одним UPDATE
+        (одинаковые задачи, посчитанные воркером один раз). Задачи, которые уже не в работе у этого воркера
+        (например, их забрал reaper и взял другой воркер), не трогаются. Коммит делает воркер.
+        """
+        result = await db_session.execute(
+            update(MLTask)
+            .where(MLTask.task_id.in_(task_ids), MLTask.worker_id == worker_id, MLTask.status == TaskStatus.IN_PROGRESS)
+            .values(status=TaskStatus.COMPLETED, prediction_result=result_data, lease_expires_at=None)
+        )
+        return result.rowcount
 
     @staticmethod
     async def refund(db_session: AsyncSession, task_id: int, reason: str = "Ошибка"):
         """
         Возврат средств в случае сбоя модели (REFUND).
         """
-        task_result = await db_session.execute(
-            select(MLTask).where(MLTask.task_id == task_id)
-        )
-        task = task_result.scalar_one_or_none()
+        await MLTaskCRUD.refund_many(db_session, [task_id], reason)
 
-        if not task or task.status == TaskStatus.FAILED:
-            return
+    @staticmethod
+    async def refund_many(
+            db_session: AsyncSession,
+            task_ids: list[int],
+            reason: str = "Ошибка",
+            status: TaskStatus = TaskStatus.FAILED,
+            from_statuses: tuple = (TaskStatus.WAITING, TaskStatus.IN_PROGRESS)
+    ) -> int:
+        """
+        Возврат средств сразу за несколько задач в одной транзакции (например, за истёкшие в очереди):
+        задачи переводятся в status (по умолчанию FAILED), баланс каждого пользователя одним UPDATE,
+        транзакции REFUND одной вставкой. Возвращается сумма, списанная за задачу (по её транзакциям).
+        Задачи не в статусах from_statuses (уже завершены, деньги уже вернули) пропускаются.
+        Возвращает число закрытых задач.
+        """
+        # Блокируем строки задач, чтобы параллельный возврат не вернул деньги дважды
+        tasks_result = await db_session.execute(
+            select(MLTask.task_id, MLTask.user_id, MLTask.model_id)
+            .where(MLTask.task_id.in_(task_ids), MLTask.status.in_(from_statuses))
+            .with_for_update()
+        )
+        tasks = tasks_result.all()
+        if not tasks:
+            return 0
 
-        # Получаем стоимость из модели через задачу
-        model_result = await db_session.execute(select(MLModel).where(MLModel.model_id == task.model_id))
-        ml_model = model_result.scalar_one()
+        # Возвращаем столько, сколько за задачу списано (SPEND минус прежние возвраты), а не текущую цену модели:
+        # модель могли удалить или изменить её стоимость
+        charged_result = await db_session.execute(
+            select(Transaction.related_task_id, func.sum(Transaction.amount))
+            .where(Transaction.related_task_id.in_([task.task_id for task in tasks]))
+            .group_by(Transaction.related_task_id)
+        )
+        charged = {task_id: -amount for task_id, amount in charged_result.all()}
 
-        # Возвращаем деньги на баланс
-        balance_result = await db_session.execute(select(Balance).where(Balance.user_id == task.user_id))
-        balance = balance_result.scalar_one()
-        balance.amount += ml_model.cost_per_prediction
+        refunds = defaultdict(Decimal)  # user_id -> сумма возврата
+        transactions = []
+        for task in tasks:
+            amount = charged.get(task.task_id, Decimal(0))
+            if amount <= 0:
+                logger.warning(f"За задачу № {task.task_id} нечего возвращать, задача закрывается без возврата")
+                continue
+            refunds[task.user_id] += amount
+            transactions.append({
+                "user_id": task.user_id,
+                "amount": amount,
+                "transaction_type": TransactionType.REFUND,
+                "description": f"Возврат средств за задачу № {task.task_id}",
+                "related_task_id": task.task_id,
+                "created_at": datetime.now()
+            })
 
-        # Обновляем статус задачи
-        task.status = TaskStatus.FAILED
-        task.prediction_result = f"Ошибка: {reason}"
+        # Возвращаем деньги на балансы
+        for user_id, amount in refunds.items():
+            await db_session.execute(
+                update(Balance).where(Balance.user_id == user_id).values(amount=Balance.amount + amount)
+            )
 
-        # Создаем транзакцию возврата
-        refund_transaction = Transaction(
-            user_id=task.user_id,
-            amount=ml_model.cost_per_prediction,
-            transaction_type=TransactionType.REFUND,
-            description=f"Возврат средств за задачу № {task.task_id}",
-            related_task_id=task.task_id
+        # Обновляем статусы задач
+        await db_session.execute(
+            update(MLTask)
+            .where(MLTask.task_id.in_([task.task_id for task in tasks]))
+            .values(status=status, prediction_result=f"Ошибка: {reason}" if status == TaskStatus.FAILED else reason)
         )
-        db_session.add(refund_transaction)
+
+        # Создаем транзакции возврата
+        if transactions:
+            await db_session.execute(insert(Transaction), transactions)
         await db_session.commit()
+        for user_id in refunds:
+            await invalidate("balances", user_id)
+        return len(tasks)
+
+    @staticmethod
+    async def cancel(db_session: AsyncSession, task_id: int, user_id: int) -> bool | None:
+        """
+        Отмена задачи пользователем: WAITING -> CANCELLED с возвратом средств в одной транзакции.
+        Строка задачи блокируется, поэтому отмена и захват задачи воркером не пересекаются:
+        воркер либо уже забрал задачу (отменить нельзя), либо увидит CANCELLED и пропустит её.
+        Возвращает None, если у пользователя нет такой задачи, False - если задача уже не в очереди.
+        """
+        result = await db_session.execute(
+            lambda_stmt(lambda: select(MLTask.task_id).where(MLTask.task_id == task_id, MLTask.user_id == user_id))
+        )
+        if result.scalar_one_or_none() is None:
+            return None
+        cancelled = await MLTaskCRUD.refund_many(
+            db_session, [task_id], "Отменена пользователем",
+            status=TaskStatus.CANCELLED, from_statuses=(TaskStatus.WAITING,)
+        )
+        return cancelled > 0
+
+    @staticmethod
+    async def get_backlog_stats(db_session: AsyncSession) -> tuple[datetime | None, int]:
+        """
+        Сигналы для автомасштабирования воркеров: время создания самой старой задачи в ожидании
+        (None, если ожидающих нет) и число задач в работе.
+        """
+        result = await db_session.execute(
+            select(
+                func.min(MLTask.created_at).filter(MLTask.status == TaskStatus.WAITING),
+                func.count().filter(MLTask.status == TaskStatus.IN_PROGRESS)
+            ).where(MLTask.status.in_([TaskStatus.WAITING, TaskStatus.IN_PROGRESS]))
+        )
+        oldest_waiting, in_progress = result.one()
+        return oldest_waiting, in_progress
 
     @staticmethod
     async def get_by_id(db_session: AsyncSession, task_id: int) -> MLTask | None:
@@ -132,7 +440,7 @@ class MLTaskCRUD:
         Получение информации о ML-запросе по его id
         """
         result = await db_session.execute(
-            select(MLTask).where(MLTask.task_id == task_id)
+            lambda_stmt(lambda: select(MLTask).where(MLTask.task_id == task_id))
         )
         return result.scalar_one_or_none()
 
@@ -143,11 +451,11 @@ class MLTaskCRUD:
         Список всех ML-запросов пользователя (от новых к старым) с возможностью ограничения количества
         """
         # Создаем базовый запрос с сортировкой от новых к старым
-        query = select(MLTask).where(MLTask.user_id == user_id).order_by(MLTask.created_at.desc())
+        query = lambda_stmt(lambda: select(MLTask).where(MLTask.user_id == user_id).order_by(MLTask.created_at.desc()))
 
-        # Если передан лимит, добавляем его к запросу
+        # Если передан лимит, добавляем его к запросу (значение лимита остаётся параметром кэшированного запроса)
         if limit:
-            query = query.limit(limit)
+            query += lambda s: s.limit(limit)
 
         result = await db_session.execute(query)
         return result.scalars().all()
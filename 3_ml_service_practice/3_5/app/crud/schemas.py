@@ -4,7 +4,7 @@
 from datetime import datetime
 from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator
 from decimal import Decimal
-from app.models.enums import TransactionType,TaskStatus
+from app.models.enums import TransactionType,TaskStatus,UserRole
 import re
 
 class UserRegSchema(BaseModel):
@@ -38,6 +38,41 @@ class UserReadSchema(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 
+class CurrentUserSchema(BaseModel):
+    """
+    Авторизованный пользователь, собранный из claims JWT (без запроса в БД)
+    """
+    user_id: int
+    user_name: str
+    email: str
+    role: UserRole
+
+
+class ApiKeyCreateSchema(BaseModel):
+    """
+    Схема для создания API-ключа
+    """
+    name: str = Field(min_length=1, max_length=100)
+
+
+class ApiKeyReadSchema(BaseModel):
+    """
+    Схема для получения API-ключей пользователя (без самого ключа)
+    """
+    key_id: int
+    name: str
+    prefix: str
+    created_at: datetime
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ApiKeyCreatedSchema(ApiKeyReadSchema):
+    """
+    Ответ на создание API-ключа: сам ключ показывается только один раз
+    """
+    key: str
+
+
 class BalanceUpdateSchema(BaseModel):
     """
     Схема для проверки корректности суммы пополнения баланса
@@ -73,6 +108,7 @@ class MLModelCreateSchema(BaseModel):
     model_name: str = Field(..., min_length=2, max_length=50)
     cost_per_prediction: Decimal = Field(default=Decimal('0.00'), ge=0)
     description: str | None = None
+    sla_seconds: int | None = Field(default=None, gt=0)  # максимальное ожидание задачи в очереди
 
 
 class MLModelReadSchema(MLModelCreateSchema):
@@ -87,6 +123,8 @@ class MLTaskCreateSchema(BaseModel):
     Схема валидации входных данных для ML-запроса. Проверка размера текста, и того что введен именно текст.
     """
     input_data: str
+    # необязательное понижение приоритета в очереди (0 - пакетная обработка)
+    priority: int | None = Field(default=None, ge=0)
     @field_validator("input_data")
     @classmethod
     def check_text(cls, v: str) -> str:
@@ -2,17 +2,31 @@
 # Функции с пользователями для использования в эндпоинтах
 # =============================================
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, lambda_stmt
 from app.models.user import User
 from app.models.balance import Balance
 from app.crud.schemas import UserAuthSchema
+from app.crud.cache import TTLCache, invalidate
 from datetime import datetime
 import logging
 from app.auth.password_hash import PasswordHash
+from config import get_settings
 
 
 logger = logging.getLogger("uvicorn.error")
 
+settings = get_settings()
+
+# Кэш версий токенов для проверки отзыва JWT: user_id -> token_version
+token_version_cache = TTLCache(
+    "token_versions",
+    maxsize=settings.TOKEN_VERSION_CACHE_MAX_SIZE,
+    ttl=settings.TOKEN_VERSION_CACHE_TTL_SECONDS
+)
+
+# Отметка в кэше для удалённого (или несуществующего) пользователя, чтобы не ходить за ним в БД
+_NO_USER = -1
+
 
 class UserCRUD:
     @staticmethod
@@ -20,7 +34,10 @@ class UserCRUD:
         """
         Поиск пользователя по ID. Только для is_deleted == False.
         """
-        result = await db_session.execute(select(User).where(User.user_id == user_id, User.is_deleted == False))
+        # lambda_stmt: запрос строится и компилируется один раз, дальше меняются только параметры
+        result = await db_session.execute(
+            lambda_stmt(lambda: select(User).where(User.user_id == user_id, User.is_deleted == False))
+        )
         return result.scalar_one_or_none()
 
     @staticmethod
@@ -28,16 +45,45 @@ class UserCRUD:
         """
         Поиск пользователя по Email. Только для is_deleted == False.
         """
-        result = await db_session.execute(select(User).where(User.email == email, User.is_deleted == False))
+        result = await db_session.execute(
+            lambda_stmt(lambda: select(User).where(User.email == email, User.is_deleted == False))
+        )
         return result.scalar_one_or_none()
 
+    @staticmethod
+    async def get_token_version(db_session: AsyncSession, user_id: int) -> int | None:
+        """
+        Текущая версия токенов активного пользователя (None, если пользователь удалён).
+        Берётся из кэша, при промахе читается одна колонка из БД.
+        """
+        version = token_version_cache.get(user_id)
+        if version is None:
+            result = await db_session.execute(
+                lambda_stmt(lambda: select(User.token_version).where(User.user_id == user_id, User.is_deleted == False))
+            )
+            version = result.scalar_one_or_none()
+            version = _NO_USER if version is None else version
+            token_version_cache.set(user_id, version)
+        return None if version == _NO_USER else version
+
+    @staticmethod
+    async def revoke_tokens(db_session: AsyncSession, user_id: int):
+        """
+        Отзывает все выданные пользователю токены: увеличивает версию токенов.
+        """
+        await db_session.execute(
+            update(User).where(User.user_id == user_id).values(token_version=User.token_version + 1)
+        )
+        await db_session.commit()
+        await invalidate(token_version_cache.name, user_id)
+
     @staticmethod
     async def get_any_by_id(db_session: AsyncSession, user_id: int) -> User | None:
         """
         Находит пользователя по ID в том числе удаленных
         """
         result = await db_session.execute(
-            select(User).where(User.user_id == user_id)
+            lambda_stmt(lambda: select(User).where(User.user_id == user_id))
         )
         return result.scalars().first()
 
@@ -53,7 +99,7 @@ class UserCRUD:
         """Создание нового пользователя с хешированием пароля.
             И создание баланса спривязкой к пользователю."""
         # Хешируем пароль
-        password_hash = PasswordHash.create(user_data.password)
+        password_hash = await PasswordHash.create(user_data.password)
         # добавляем нового пользователя в БД
         new_user = User(
             user_name=user_data.user_name,
@@ -73,6 +119,13 @@ class UserCRUD:
         return new_user
 
 
+    @staticmethod
+    async def update_password_hash(db_session: AsyncSession, user: User, password_hash: str):
+        """Сохраняет пересчитанный хеш пароля (после смены параметров хеширования)"""
+        user.password_hash = password_hash
+        await db_session.commit()
+        logger.info(f"Хеш пароля пользователя {user.user_id} пересчитан с новыми параметрами")
+
     @staticmethod
     async def delete(db_session: AsyncSession, user_id: int) -> bool:
         """Удаление пользователя. Возвращает True, если удален, False если не найден.
@@ -92,8 +145,12 @@ class UserCRUD:
         # 3. Обновляем статус и email
         user.email = new_email
         user.is_deleted = True
+        # Отзываем выданные токены
+        user.token_version += 1
 
         await db_session.commit()
+        # Сразу сбрасываем версию токенов на всех репликах, чтобы удалённый не сохранил доступ
+        await invalidate(token_version_cache.name, user_id)
         logger.info(f"Пользователь {user_id} удален (мягко). Email изменен: {old_email} -> {new_email}")
         return True
 
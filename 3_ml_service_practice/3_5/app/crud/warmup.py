@@ -0,0 +1,25 @@
+# =============================================
+# Горячие запросы для прогрева пула соединений при старте приложения
+# =============================================
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.crud.user import UserCRUD
+from app.crud.balance import BalanceCRUD
+from app.crud.ml_task import MLTaskCRUD
+from app.crud.ml_model import MLModelCRUD
+
+
+async def run_hot_queries(db_session: AsyncSession):
+    """
+    Выполняет самые частые запросы приложения с фиктивными параметрами.
+    Результат не важен: на соединении остаются подготовленные asyncpg statement-ы.
+    """
+    await UserCRUD.get_by_email(db_session, "")
+    await UserCRUD.get_by_id(db_session, 0)
+    await UserCRUD.get_any_by_id(db_session, 0)
+    await BalanceCRUD.get_any(db_session, 0)
+    await BalanceCRUD.get_user_transactions(db_session, 0)
+    await MLTaskCRUD.get_by_id(db_session, 0)
+    await MLTaskCRUD.get_history(db_session, 0)
+    await MLTaskCRUD.get_history(db_session, 0, limit=5)
+    await MLModelCRUD.get(db_session, 0)
+    await MLModelCRUD.get_all(db_session)
@@ -0,0 +1,18 @@
+# =============================================
+# ORM таблица API-ключей для машинных клиентов
+# =============================================
+import datetime
+from database.database import mapper_registry
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
+
+@mapper_registry.mapped
+class ApiKey:
+    __tablename__ = 'api_keys'
+    key_id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('users.user_id'), index=True)
+    name = Column(String(100))
+    # SHA-256 от ключа (hex). Сам ключ не хранится, показывается пользователю один раз при создании
+    key_hash = Column(String(64), unique=True, nullable=False)
+    prefix = Column(String(12))  # начало ключа, чтобы пользователь мог отличить ключи в списке
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    is_revoked = Column(Boolean, default=False)
@@ -21,3 +21,4 @@ class TaskStatus(Enum):
     COMPLETED = "Completed"
     FAILED = "Failed"
     VALIDATION_ERROR = "ValidationError"
+    CANCELLED = "Cancelled"  # отменена пользователем до начала обработки, деньги возвращены
@@ -13,3 +13,5 @@ class MLModel:
     model_name = Column(String)
     cost_per_prediction = Column(Numeric(precision=15, scale=2), default=Decimal('0.00')) # цена за одно предсказание
     description = Column(String)
+    # SLA: сколько секунд задача может ждать в очереди, потом она истекает и деньги возвращаются (NULL - без ограничения)
+    sla_seconds = Column(Integer, nullable=True)
@@ -4,12 +4,14 @@
 import datetime
 from .enums import TaskStatus
 from database.database import mapper_registry
-from sqlalchemy import Column, Integer, String, Enum, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Enum, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 
 @mapper_registry.mapped
 class MLTask:
     __tablename__ ='ml_tasks'
+    # ключ идемпотентности уникален в пределах пользователя (NULL у задач без ключа не конфликтуют)
+    __table_args__ = (Index("ix_ml_tasks_user_idempotency_key", "user_id", "idempotency_key", unique=True),)
     task_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.user_id'))
     model_id = Column(Integer, ForeignKey('models.model_id'))
@@ -17,5 +19,11 @@ class MLTask:
     status = Column(Enum(TaskStatus))
     prediction_result=Column(String)
     created_at = Column(DateTime, default=datetime.datetime.now)
+    # аренда задачи воркером: воркер продлевает lease_expires_at, пока считает задачу.
+    # Если воркер умер, аренда истекает и задачу забирает reaper
+    worker_id = Column(String(50))
+    lease_expires_at = Column(DateTime, index=True)
+    reclaim_count = Column(Integer, default=0, nullable=False)  # сколько раз задачу забирали у умершего воркера
+    idempotency_key = Column(String(255))  # заголовок Idempotency-Key запроса, создавшего задачу
     #  связь с таблицей транзакций
     transactions = relationship("Transaction", back_populates="ml_tasks")
@@ -0,0 +1,12 @@
+# =============================================
+# ORM таблица корзин токенов общего ограничителя частоты запросов (RATE_LIMIT_BACKEND=postgres)
+# =============================================
+from database.database import mapper_registry
+from sqlalchemy import Column, String, Float, DateTime
+
+@mapper_registry.mapped
+class RateLimitBucket:
+    __tablename__ = 'rate_limit_buckets'
+    key = Column(String(200), primary_key=True)  # маршрут и пользователь/IP, например predict:user:5
+    tokens = Column(Float, nullable=False)  # сколько запросов осталось в корзине
+    updated_at = Column(DateTime(timezone=True), nullable=False)  # момент последнего пересчёта
@@ -1,8 +1,9 @@
 # =============================================
 # ORM таблица Пользователи
 # =============================================
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Enum
 from sqlalchemy.orm import relationship
+from .enums import UserRole
 from database.database import mapper_registry
 
 @mapper_registry.mapped
@@ -14,6 +15,9 @@ class User:
     password_hash = Column(String)
     registration_date = Column(DateTime)
     is_deleted = Column(Boolean, default=False)  # флаг об удалении
+    role = Column(Enum(UserRole), default=UserRole.USER, nullable=False)
+    # версия токенов: увеличивается при отзыве, токены со старой версией перестают приниматься
+    token_version = Column(Integer, default=0, nullable=False)
     # ORM-связь с классом Transaction
     transactions = relationship("Transaction", back_populates="user")
     balance = relationship("Balance", back_populates="user")
@@ -0,0 +1,140 @@
+# =============================================
+# Ограничение частоты запросов (token bucket) по пользователю или IP
+# =============================================
+from fastapi import Depends, HTTPException, Request, status
+from sqlalchemy import text
+from collections import OrderedDict
+from app.auth.access_token import get_optional_user
+from app.crud.schemas import CurrentUserSchema
+from app.models.rate_limit import RateLimitBucket  # регистрирует таблицу для create_all
+from database.database import get_session_local, get_engine
+from metrics import metrics
+from config import get_settings
+import logging
+import math
+import time
+
+logger = logging.getLogger("uvicorn.error")
+
+# Списание токена одним запросом: корзина пополняется за прошедшее время и, если в ней есть токен,
+# уменьшается на 1. Если токена нет — строка не обновляется и ничего не возвращается.
+TAKE_TOKEN_QUERY = text("""
+    INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+    VALUES (:key, CAST(:capacity AS double precision) - 1, now())
+    ON CONFLICT (key) DO UPDATE
+    SET tokens = LEAST(CAST(:capacity AS double precision),
+                       b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * CAST(:rate AS double precision)) - 1,
+        updated_at = now()
+    WHERE LEAST(CAST(:capacity AS double precision),
+                b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * CAST(:rate AS double precision)) >= 1
+    RETURNING b.tokens
+""")
+
+
+class TokenBucketLimiter:
+    """
+    Корзины токенов в памяти процесса (у каждой реплики свои).
+    Корзина вмещает capacity токенов и пополняется со скоростью rate токенов в секунду;
+    каждый запрос забирает один токен. Число корзин ограничено: давно не использованные вытесняются.
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # ключ -> (токены, момент пересчёта)
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        """Забирает токен. Возвращает 0, если запрос разрешён, иначе сколько секунд ждать следующего токена"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+async def _take_shared(key: str, capacity: float, rate: float) -> float:
+    """Забирает токен из корзины в Postgres (общей для всех реплик). Retry-After оценивается по скорости"""
+    async with get_session_local()(bind=get_engine()) as db_session:
+        result = await db_session.execute(TAKE_TOKEN_QUERY, {"key": key, "capacity": capacity, "rate": rate})
+        allowed = result.first() is not None
+        await db_session.commit()
+    return 0.0 if allowed else 1 / rate
+
+
+def _get_limiter() -> TokenBucketLimiter:
+    if getattr(_get_limiter, "_limiter", None) is None:
+        _get_limiter._limiter = TokenBucketLimiter(maxsize=get_settings().RATE_LIMIT_MAX_BUCKETS)
+    return _get_limiter._limiter
+
+
+async def _take(key: str, capacity: float, rate: float) -> float:
+    """Забирает токен из корзины выбранного бэкенда (RATE_LIMIT_BACKEND). Возвращает Retry-After или 0"""
+    if get_settings().RATE_LIMIT_BACKEND == "postgres":
+        try:
+            return await _take_shared(key, capacity, rate)
+        except Exception as e:
+            # Недоступная БД не должна ломать маршрут: пропускаем запрос, но пишем в лог
+            logger.warning(f"Ограничитель частоты в Postgres недоступен: {e}")
+            return 0.0
+    return _get_limiter().take(key, capacity, rate)
+
+
+async def _get_login(request: Request, login_field: str) -> str:
+    """Логин из тела запроса (JSON или форма); тело уже прочитано FastAPI и берётся из кэша запроса"""
+    try:
+        if request.headers.get("content-type", "").startswith("application/json"):
+            data = await request.json()
+        else:
+            data = await request.form()
+        login = data.get(login_field) if hasattr(data, "get") else None
+    except Exception:
+        login = None
+    return str(login or "").strip().lower()[:254]
+
+
+def rate_limit(route: str, login_field: str | None = None):
+    """
+    Ограничение частоты запросов маршрута, передаётся в dependencies=[...] декоратора маршрута.
+    Лимиты берутся из настроек RATE_LIMIT_<ROUTE>_PER_MINUTE (скорость) и RATE_LIMIT_<ROUTE>_BURST (запас).
+    Ключ - пользователь (по токену или API-ключу), для анонимных запросов - IP клиента
+    (за nginx - из X-Forwarded-For). login_field - поле тела с логином (для входа): тогда ключ анонимного
+    запроса - логин вместе с IP, и перебор паролей одного клиента не блокирует вход остальным,
+    а каждый запрос ещё списывает токен из общей корзины IP (RATE_LIMIT_<ROUTE>_IP_PER_MINUTE и _IP_BURST),
+    чтобы с одного адреса нельзя было перебирать много аккаунтов. Пустая любая из корзин - отказ.
+    При превышении отвечает 429 с заголовком Retry-After.
+    """
+    async def apply_rate_limit(request: Request, user: CurrentUserSchema | None = Depends(get_optional_user)):
+        settings = get_settings()
+        per_minute = getattr(settings, f"RATE_LIMIT_{route.upper()}_PER_MINUTE")
+        capacity = getattr(settings, f"RATE_LIMIT_{route.upper()}_BURST")
+        if not settings.RATE_LIMIT_ENABLED or not per_minute:
+            return
+        rate = per_minute / 60
+        if user is not None:
+            retry_after = await _take(f"{route}:user:{user.user_id}", capacity, rate)
+        else:
+            ip_key = f"{route}:ip:{request.client.host if request.client else 'unknown'}"
+            if login_field is None:
+                retry_after = await _take(ip_key, capacity, rate)
+            else:
+                login = await _get_login(request, login_field)
+                retry_after = await _take(f"{ip_key}:login:{login}", capacity, rate)
+                # общая корзина IP списывается всегда, даже если корзина логина уже пуста
+                ip_per_minute = getattr(settings, f"RATE_LIMIT_{route.upper()}_IP_PER_MINUTE")
+                ip_capacity = getattr(settings, f"RATE_LIMIT_{route.upper()}_IP_BURST")
+                retry_after = max(retry_after, await _take(ip_key, ip_capacity, ip_per_minute / 60))
+
+        if retry_after > 0:
+            metrics.inc("rate_limited", route=route)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Слишком много запросов, повторите попытку позже",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+
+    return Depends(apply_rate_limit)
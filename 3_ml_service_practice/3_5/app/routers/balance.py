@@ -1,7 +1,7 @@
 from fastapi import APIRouter, HTTPException, Depends
 from app.crud.balance import BalanceCRUD
 from app.crud.user import UserCRUD
-from  database.database import get_session
+from  database.database import get_session, get_readonly_session, db_route, EXPORT_POOL
 import logging
 from app.crud.schemas import BalanceUpdateSchema, BalanceCurrentSchema, TransactionReadSchema
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -19,7 +19,7 @@ balance_router = APIRouter()
    response_model=BalanceCurrentSchema,
    summary="Получить баланс"
 )
-async def get(user_id: int, db_session: AsyncSession = Depends(get_session)):
+async def get(user_id: int, db_session: AsyncSession = Depends(get_readonly_session)):
     """
     Просмотр текущего баланса активного пользователя.
     """
@@ -54,9 +54,10 @@ async def top_up(
 @balance_router.get(
     "/transactions/{user_id}",
     response_model=list[TransactionReadSchema],
-    summary="Получить историю транзакций пользователя"
+    summary="Получить историю транзакций пользователя",
+    dependencies=[db_route(pool=EXPORT_POOL)]  # полная история — тяжёлая выгрузка
 )
-async def get_transaction_history(user_id: int, db_session: AsyncSession = Depends(get_session)):
+async def get_transaction_history(user_id: int, db_session: AsyncSession = Depends(get_readonly_session)):
     """
     История транзакций любого пользователя, в том числе удаленного.
     """
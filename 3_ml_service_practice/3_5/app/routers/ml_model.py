@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from database.database import get_session
+from database.database import get_session, get_readonly_session
 from app.crud.ml_model import MLModelCRUD
 from app.crud.schemas import MLModelReadSchema, MLModelCreateSchema
 import logging
@@ -20,14 +20,14 @@ async def create_model(model_data: MLModelCreateSchema, db_session: AsyncSession
     response_model=MLModelReadSchema,
     summary="Получить  ML-модель по id"
 )
-async def get(model_id: int,  db_session: AsyncSession=Depends(get_session)):
+async def get(model_id: int,  db_session: AsyncSession=Depends(get_readonly_session)):
     model = await MLModelCRUD.get(db_session, model_id)
     if not model:
         raise HTTPException(status_code=404, detail="ML-модель не найдена")
     return model
 
 @ml_model_router.get("/get_all", response_model=list[MLModelReadSchema], summary="Список всех доступных моделей")
-async def get_all(db_session: AsyncSession = Depends(get_session)):
+async def get_all(db_session: AsyncSession = Depends(get_readonly_session)):
     """Возвращает список моделей с их ценами."""
     try:
         return await MLModelCRUD.get_all(db_session)
@@ -1,20 +1,21 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Header, Response, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from database.database import get_session
+from database.database import get_session, get_readonly_session, db_route, EXPORT_POOL
 from app.crud.ml_task import MLTaskCRUD
 from app.crud.ml_model import MLModelCRUD
 from app.crud.schemas import MLTaskReadSchema
 from app.models.enums import TaskStatus
 import logging
 from app.crud.user import UserCRUD
-import json
-from datetime import datetime
-from aio_pika import connect, Message
-from config import get_settings
-from app.auth.access_token import get_current_user
-from app.models.user import User
+from app.broker import publish_task, get_task_priority
+from app.admission import admission_control
+from app.auth.access_token import get_current_user, api_key_sec
+from app.rate_limit import rate_limit
+from app.crud.schemas import CurrentUserSchema
 from fastapi.security import APIKeyCookie
 from app.crud.schemas import MLTaskCreateSchema
+from metrics import metrics
+from datetime import datetime
 
 # Указываем FastAPI, что мы используем куку с именем access_token
 cookie_sec = APIKeyCookie(name="access_token", auto_error=False)
@@ -22,29 +23,40 @@ cookie_sec = APIKeyCookie(name="access_token", auto_error=False)
 logger = logging.getLogger("uvicorn.error")
 ml_task_router = APIRouter()
 
-async def send_to_rabbit(task_id: int, input_text: str, model_id: int):
-    """Функция для работы с очередью"""
-    settings = get_settings()
-    payload = {
-        "task_id": str(task_id),
-        "features": {"input": input_text},
-        "model": model_id,
-        "timestamp": datetime.now().isoformat()
+async def send_to_rabbit(
+        task_id: int,
+        input_text: str,
+        model_id: int,
+        priority: int = 1,
+        user_id: int | None = None,
+        sla_seconds: int | None = None,
+        created_at: datetime | None = None
+):
+    """
+    Функция для работы с очередью.
+    sla_seconds - SLA модели: сколько задача может ждать в очереди. Не взятая вовремя задача истекает
+    (expiration сообщения), и воркер возвращает за неё деньги, не тратя время на расчёт.
+    """
+    await publish_task(task_id, input_text, model_id, priority, user_id, sla_seconds, created_at)
+
+def replay_prediction(response: Response, task_id: int, task_status: TaskStatus) -> dict:
+    """Ответ на повтор запроса с тем же Idempotency-Key: исходная задача и её текущий статус"""
+    metrics.inc("idempotent_replays")
+    response.headers["Idempotent-Replayed"] = "true"
+    return {
+        "task_id": task_id,
+        "status": task_status,
+        "message": "Задача поставлена в очередь" if task_status == TaskStatus.WAITING else "Задача уже создана"
     }
-    connection = await connect(settings.RABBITMQ_URL)
-    async with connection:
-        channel = await connection.channel()
-        await channel.declare_queue("ml_tasks", durable=True)
-        await channel.default_exchange.publish(
-            Message(json.dumps(payload).encode()),
-            routing_key="ml_tasks"
-        )
 
-@ml_task_router.post("/predict", summary="Запуск ML-предсказания", dependencies=[Depends(cookie_sec)])
+
+@ml_task_router.post("/predict", summary="Запуск ML-предсказания", dependencies=[Depends(cookie_sec), Depends(api_key_sec), rate_limit("predict"), Depends(admission_control)])
 async def run_prediction(
         input_data: MLTaskCreateSchema,
+        response: Response,
         db_session: AsyncSession = Depends(get_session),
-        current_user: User = Depends(get_current_user) # получения объекта User из кук
+        current_user: CurrentUserSchema = Depends(get_current_user), # пользователь из токена в куках
+        idempotency_key: str | None = Header(None, alias="Idempotency-Key", min_length=1, max_length=255)
 ):
     """
     **Механизм работы эндпоинта:**
@@ -55,24 +67,54 @@ async def run_prediction(
     - Задача передается в очередь -> списание средств со счета.
     - Забирается воркером.
     - Сохранения результата в БД.
+    - С заголовком Idempotency-Key повтор запроса (например, после таймаута) возвращает исходную задачу
+      и её статус без повторного списания (заголовок ответа Idempotent-Replayed: true).
+      Если задача ещё ждёт, она отправляется в очередь ещё раз: исходный запрос мог упасть после списания,
+      но до отправки. Лишнее сообщение безопасно - воркер забирает задачу условным UPDATE.
     """
     try:
         # получаем актуальную модель из БД
         active_model = await MLModelCRUD.get_first_model(db_session)
         # Создаем задачу в БД со статусом WAITING (деньги спишутся внутри CRUD)
-        task = await MLTaskCRUD.create(
-            db_session,
-            user_id=current_user.user_id, # ID из кук
-            model_id=active_model.model_id,
-            input_data=input_data.input_data
-        )
+        if idempotency_key is None:
+            task = await MLTaskCRUD.create(
+                db_session,
+                user_id=current_user.user_id, # ID из кук
+                model_id=active_model.model_id,
+                input_data=input_data.input_data
+            )
+            task_id = task.task_id
+        else:
+            task_id, created = await MLTaskCRUD.get_or_create(
+                db_session,
+                user_id=current_user.user_id,
+                model_id=active_model.model_id,
+                input_data=input_data.input_data,
+                idempotency_key=idempotency_key
+            )
+            if not created:
+                # повтор: задача уже создана исходным запросом
+                task = await MLTaskCRUD.get_by_id(db_session, task_id)
+                if task.status == TaskStatus.WAITING:
+                    ml_model = await MLModelCRUD.get_cached(db_session, task.model_id)
+                    await send_to_rabbit(
+                        task.task_id, task.input_data, task.model_id,
+                        get_task_priority(task.input_data, current_user.role, input_data.priority),
+                        current_user.user_id, ml_model.sla_seconds if ml_model else None,
+                        created_at=task.created_at
+                    )
+                return replay_prediction(response, task_id, task.status)
 
         # Отправка в очередь
-        await send_to_rabbit(task.task_id, input_data.input_data, active_model.model_id)
+        priority = get_task_priority(input_data.input_data, current_user.role, input_data.priority)
+        await send_to_rabbit(
+            task_id, input_data.input_data, active_model.model_id,
+            priority, current_user.user_id, active_model.sla_seconds
+        )
 
         # Возвращаем ответ сразу, не дожидаясь завершения задачи
         return {
-            "task_id": task.task_id,
+            "task_id": task_id,
             "status": TaskStatus.WAITING,
             "message": "Задача поставлена в очередь"
         }
@@ -85,7 +127,7 @@ async def run_prediction(
     response_model=MLTaskReadSchema,
     summary="Получение информации о задаче по id"
 )
-async def get_task(task_id: int,db_session: AsyncSession = Depends(get_session)):
+async def get_task(task_id: int,db_session: AsyncSession = Depends(get_readonly_session)):
     task = await MLTaskCRUD.get_by_id(db_session, task_id)
     if not task:
         raise HTTPException(
@@ -96,12 +138,41 @@ async def get_task(task_id: int,db_session: AsyncSession = Depends(get_session))
 
 
 
+@ml_task_router.delete(
+    "/{task_id}",
+    summary="Отмена задачи",
+    dependencies=[Depends(cookie_sec), Depends(api_key_sec)]
+)
+async def cancel_task(
+        task_id: int,
+        db_session: AsyncSession = Depends(get_session),
+        current_user: CurrentUserSchema = Depends(get_current_user)
+):
+    """
+    Отмена задачи, которая ещё ждёт в очереди: статус CANCELLED и мгновенный возврат средств.
+    Воркер пропустит отменённую задачу, не выполняя её. Задачу в работе или завершённую отменить нельзя.
+    """
+    cancelled = await MLTaskCRUD.cancel(db_session, task_id, current_user.user_id)
+    if cancelled is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Задача не найдена"
+        )
+    if not cancelled:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Задачу уже нельзя отменить: она в работе или завершена"
+        )
+    return {"message": f"Задача № {task_id} отменена, средства возвращены"}
+
+
 @ml_task_router.get(
     "/history/{user_id}",
     response_model=list[MLTaskReadSchema],
-    summary="Получить историю ML-запросов пользователя"
+    summary="Получить историю ML-запросов пользователя",
+    dependencies=[db_route(pool=EXPORT_POOL)]  # полная история — тяжёлая выгрузка
 )
-async def get_history(user_id: int, db_session: AsyncSession = Depends(get_session)):
+async def get_history(user_id: int, db_session: AsyncSession = Depends(get_readonly_session)):
     """
     Список ML-запросов любого пользователя, в том числе удаленного.
     """
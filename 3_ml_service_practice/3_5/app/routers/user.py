@@ -1,13 +1,17 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Response
+from fastapi import APIRouter, HTTPException, status, Depends, Response, Request
 from app.crud.user import UserCRUD
-from  database.database import get_session
+from  database.database import get_session, get_readonly_session, db_route, EXPORT_POOL
 from typing import Dict
 import logging
-from app.crud.schemas import UserRegSchema, UserAuthSchema, UserReadSchema
+from app.crud.schemas import UserRegSchema, UserAuthSchema, UserReadSchema, CurrentUserSchema
+from app.crud.schemas import ApiKeyCreateSchema, ApiKeyReadSchema, ApiKeyCreatedSchema
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import EmailStr
 from app.auth.password_hash import PasswordHash
-from app.auth.access_token import set_token_cookie, delete_token_cookie
+from app.auth.access_token import set_token_cookie, delete_token_cookie, set_access_cookie, refresh_access_token, REFRESH_TOKEN_COOKIE
+from app.auth.access_token import get_current_user, api_key_sec
+from app.crud.api_key import ApiKeyCRUD
+from app.rate_limit import rate_limit
 from config import get_settings
 from fastapi.security import APIKeyCookie
 
@@ -31,7 +35,8 @@ user_router = APIRouter()
    '/signup',
    response_model= Dict[str, str],
    status_code=status.HTTP_201_CREATED,
-   summary="Регистрация пользователя"
+   summary="Регистрация пользователя",
+   dependencies=[rate_limit("signup")]
 )
 async def signup(
         response: Response,
@@ -55,9 +60,9 @@ async def signup(
         )
     # Создание нового пользователя
 
-    await UserCRUD.create(db_session, user_data)
-    # сохраняем токен в куки
-    set_token_cookie(response, user_email=user_data.email)
+    new_user = await UserCRUD.create(db_session, user_data)
+    # сохраняем токены в куки
+    set_token_cookie(response, user=new_user)
     logger.info(f"Создан новый пользователь с почтой {user_data.email}")
     return   {"message": "Пользователь успешно зарегистрирован"}
 
@@ -65,7 +70,8 @@ async def signup(
 
 @user_router.post(
     '/login',
-    summary="Авторизация пользователя"
+    summary="Авторизация пользователя",
+    dependencies=[rate_limit("login", login_field="email")]
 )
 async def login(
         response: Response,
@@ -83,17 +89,36 @@ async def login(
             detail="Данная почта не зарегистрирована"
         )
     # проверка пароля
-    if not PasswordHash.verify(user_data.password, user.password_hash):
+    is_valid, new_hash = await PasswordHash.verify_and_update(user_data.password, user.password_hash)
+    if not is_valid:
         logger.warning(f"Неверный пароль для: {user_data.email}")
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Неверный пароль"
         )
-   # сохраняем токен в куки
-    set_token_cookie(response, user_email=user.email)
+    if new_hash:
+        await UserCRUD.update_password_hash(db_session, user, new_hash)
+   # сохраняем токены в куки
+    set_token_cookie(response, user=user)
     return {"message": "Успешная авторизация"}
 
 
+@user_router.post("/refresh", summary="Обновление access-токена")
+async def refresh(
+        request: Request,
+        response: Response,
+        db_session: AsyncSession = Depends(get_session)
+) -> Dict[str, str]:
+    """
+    Выпускает новый короткоживущий access-токен по refresh-токену из кук.
+    """
+    refresh_token = request.cookies.get(REFRESH_TOKEN_COOKIE)
+    if not refresh_token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Вы не авторизованы")
+    set_access_cookie(response, await refresh_access_token(db_session, refresh_token))
+    return {"message": "Токен обновлен"}
+
+
 @user_router.post("/logout", summary="Выход из аккаунта")
 async def logout(response: Response):
     """
@@ -103,12 +128,76 @@ async def logout(response: Response):
     return {"message": "Вы вышли из аккаунта"}
 
 
+@user_router.post(
+    '/api_keys',
+    response_model=ApiKeyCreatedSchema,
+    status_code=status.HTTP_201_CREATED,
+    summary="Создать API-ключ",
+    dependencies=[Depends(cookie_sec), Depends(api_key_sec)]
+)
+async def create_api_key(
+        key_data: ApiKeyCreateSchema,
+        db_session: AsyncSession = Depends(get_session),
+        current_user: CurrentUserSchema = Depends(get_current_user)
+):
+    """
+    Создает API-ключ для машинных клиентов. Ключ передается в заголовке `Authorization: Bearer <ключ>`.
+    Ключ показывается только в этом ответе, в БД хранится только его SHA-256.
+    """
+    api_key, key = await ApiKeyCRUD.create(db_session, current_user.user_id, key_data.name)
+    return ApiKeyCreatedSchema(
+        key_id=api_key.key_id,
+        name=api_key.name,
+        prefix=api_key.prefix,
+        created_at=api_key.created_at,
+        key=key
+    )
+
+
+@user_router.get(
+    '/api_keys',
+    response_model=list[ApiKeyReadSchema],
+    summary="Список API-ключей",
+    dependencies=[Depends(cookie_sec), Depends(api_key_sec)]
+)
+async def get_api_keys(
+        db_session: AsyncSession = Depends(get_readonly_session),
+        current_user: CurrentUserSchema = Depends(get_current_user)
+):
+    """
+    Действующие API-ключи текущего пользователя
+    """
+    return await ApiKeyCRUD.get_user_keys(db_session, current_user.user_id)
+
+
+@user_router.delete(
+    '/api_keys/{key_id}',
+    summary="Отозвать API-ключ",
+    dependencies=[Depends(cookie_sec), Depends(api_key_sec)]
+)
+async def revoke_api_key(
+        key_id: int,
+        db_session: AsyncSession = Depends(get_session),
+        current_user: CurrentUserSchema = Depends(get_current_user)
+):
+    """
+    Отзывает API-ключ текущего пользователя
+    """
+    revoked = await ApiKeyCRUD.revoke(db_session, current_user.user_id, key_id)
+    if not revoked:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"API-ключ с id {key_id} не найден"
+        )
+    return {"message": f"API-ключ с id {key_id} отозван"}
+
+
 @user_router.get(
     '/get_user_by_id',
     response_model=UserReadSchema,
     summary="Получить пользователя по id"
 )
-async def get_user_by_id(user_id: int,  db_session: AsyncSession=Depends(get_session)):
+async def get_user_by_id(user_id: int,  db_session: AsyncSession=Depends(get_readonly_session)):
     """
     Получить активного пользователя по id
     """
@@ -123,7 +212,7 @@ async def get_user_by_id(user_id: int,  db_session: AsyncSession=Depends(get_ses
     response_model=UserReadSchema,
     summary="Получить пользователя по emai"
 )
-async def get_user_by_email(email: EmailStr,  db_session: AsyncSession=Depends(get_session)):
+async def get_user_by_email(email: EmailStr,  db_session: AsyncSession=Depends(get_readonly_session)):
     """
     Получить активного пользователя по emai
     """
@@ -136,9 +225,10 @@ async def get_user_by_email(email: EmailStr,  db_session: AsyncSession=Depends(g
 @user_router.get(
     "/get_all_users",
     response_model=list[UserReadSchema],
-    summary="Получить пользователей"
+    summary="Получить пользователей",
+    dependencies=[db_route(pool=EXPORT_POOL)]  # список без ограничения — тяжёлая выгрузка
 )
-async def get_all_users(db_session: AsyncSession = Depends(get_session)):
+async def get_all_users(db_session: AsyncSession = Depends(get_readonly_session)):
     """
     Получить список всех активных пользователей
     """
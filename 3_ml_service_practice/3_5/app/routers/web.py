@@ -7,21 +7,24 @@ from app.auth.access_token import get_current_user, get_optional_user, set_token
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from sqlalchemy.orm import selectinload
-from database.database import get_session
+from database.database import get_session, get_readonly_session, db_route, EXPORT_POOL
 from app.crud.user import UserCRUD
 from app.crud.balance import BalanceCRUD
 from app.crud.ml_task import MLTaskCRUD
 from app.crud.ml_model import MLModelCRUD
 from app.crud.schemas import MLTaskReadSchema, MLTaskCreateSchema
 from app.routers.ml_task import send_to_rabbit
+from app.broker import get_task_priority
+from app.rate_limit import rate_limit
+from app.admission import admission_control
 from app.crud.schemas import UserRegSchema
 from app.models.enums import TaskStatus
 import logging
 import json
 from datetime import datetime
-from aio_pika import connect, Message
+from aio_pika import Message
 from config import get_settings
-from app.models.user import User
+from app.crud.schemas import CurrentUserSchema
 from decimal import Decimal
 from fastapi.security import APIKeyCookie
 
@@ -41,7 +44,7 @@ async def get_home_page(request: Request):
 @web_router.get("/signup", response_class=HTMLResponse)
 async def signup_page(
         request: Request,
-        user: User = Depends(get_optional_user)  # Проверяем "тихо"
+        user: CurrentUserSchema = Depends(get_optional_user)  # Проверяем "тихо"
 ):
     """Страница регистрации"""
     # Если пользователь уже авторизован переадресовываем в профиль
@@ -52,7 +55,7 @@ async def signup_page(
 
 
 
-@web_router.post("/signup")
+@web_router.post("/signup", dependencies=[rate_limit("signup")])
 async def signup_handler(
         request: Request,
         user_name: str = Form(...),
@@ -79,7 +82,7 @@ async def signup_handler(
 
         # 4. Автоматический вход: создаем редирект и ставим куку
         redirect = RedirectResponse(url="/profile", status_code=status.HTTP_303_SEE_OTHER)
-        set_token_cookie(redirect, user_email=new_user.email)
+        set_token_cookie(redirect, user=new_user)
 
         return redirect
 
@@ -95,7 +98,7 @@ async def signup_handler(
 @web_router.get("/login", response_class=HTMLResponse)
 async def login_page(
     request: Request,
-    user: User = Depends(get_optional_user) # Проверяем "тихо"
+    user: CurrentUserSchema = Depends(get_optional_user) # Проверяем "тихо"
 ):
     """Страница авторизации"""
     # Если пользователь уже авторизован переадресовываем в профиль
@@ -106,7 +109,7 @@ async def login_page(
     return templates.TemplateResponse("login.html", {"request": request})
 
 
-@web_router.post("/login")
+@web_router.post("/login", dependencies=[rate_limit("login", login_field="username")])
 async def login_handler(
         request: Request,
         username: str = Form(...),  # Имя поля в HTML 'name="username"'
@@ -117,18 +120,24 @@ async def login_handler(
     # 1. Проверяем пользователя
     user = await UserCRUD.get_by_email(db_session, username)
 
-    if not user or not PasswordHash.verify(password, user.password_hash):
+    is_valid, new_hash = (False, None)
+    if user:
+        is_valid, new_hash = await PasswordHash.verify_and_update(password, user.password_hash)
+
+    if not is_valid:
         # Если ошибка — возвращаем ту же страницу, но с текстом ошибки
         return templates.TemplateResponse(
             "login.html",
             {"request": request, "error": "Неверный email или пароль"}
         )
+    if new_hash:
+        await UserCRUD.update_password_hash(db_session, user, new_hash)
 
     # 2. Если всё ок — создаем редирект в личный кабинет
     redirect = RedirectResponse(url="/profile", status_code=status.HTTP_303_SEE_OTHER)
 
     # 3. Устанавливаем куку в этот редирект
-    set_token_cookie(redirect, user_email=user.email)
+    set_token_cookie(redirect, user=user)
 
     return redirect
 
@@ -137,15 +146,15 @@ async def login_handler(
 @web_router.get("/profile", response_class=HTMLResponse)
 async def get_profile_page(
     request: Request,
-    user: User = Depends(get_current_user),
-    db_session: AsyncSession = Depends(get_session)
+    user: CurrentUserSchema = Depends(get_current_user),
+    db_session: AsyncSession = Depends(get_readonly_session)
 ):
     """Главная страница профиля"""
     # Получаем первую модель, чтобы узнать её стоимость
     active_model = await MLModelCRUD.get_first_model(db_session)
 
     # получаем баланс из бД
-    user_balance = await BalanceCRUD.get_any(db_session, user.user_id)
+    user_balance = await BalanceCRUD.get_cached(db_session, user.user_id)
 
     #   получаем 5 последних задач
     history = await MLTaskCRUD.get_history(db_session, user_id=user.user_id, limit=5)
@@ -163,12 +172,12 @@ async def get_profile_page(
 @web_router.get("/profile/top_up", response_class=HTMLResponse)
 async def top_up_page(
         request: Request,
-        user: User = Depends(get_current_user),
-        db_session: AsyncSession = Depends(get_session)  # Добавь сессию
+        user: CurrentUserSchema = Depends(get_current_user),
+        db_session: AsyncSession = Depends(get_readonly_session)  # Добавь сессию
 ):
     """ Отображение старинцы пополнения баланса"""
     # Получаем объект баланса из БД
-    user_balance = await BalanceCRUD.get_any(db_session, user.user_id)
+    user_balance = await BalanceCRUD.get_cached(db_session, user.user_id)
 
     return templates.TemplateResponse("top_up.html", {
         "request": request,
@@ -181,7 +190,7 @@ async def top_up_page(
 async def do_top_up(
         request: Request,
         amount: float = Form(...),  # Получаем сумму из HTML-формы
-        user: User = Depends(get_current_user),
+        user: CurrentUserSchema = Depends(get_current_user),
         db_session: AsyncSession = Depends(get_session)
 ):
     """Логика пополнения баланса"""
@@ -200,11 +209,25 @@ async def do_top_up(
             "request": request, "user": user, "error": str(e)
         })
 
-@web_router.get("/profile/transactions", response_class=HTMLResponse)
+@web_router.post("/profile/tasks/{task_id}/cancel")
+async def do_cancel_task(
+        task_id: int,
+        next: str = Form("/profile"),  # страница, на которую вернуться
+        user: CurrentUserSchema = Depends(get_current_user),
+        db_session: AsyncSession = Depends(get_session)
+):
+    """Отмена задачи из очереди с возвратом средств (кнопка в профиле и истории)"""
+    await MLTaskCRUD.cancel(db_session, task_id, user.user_id)
+    # Возвращаемся только на свои страницы, чтобы форма не стала открытым редиректом;
+    # если задачу уже взяли в работу, её статус виден на странице
+    url = next if next in ("/profile", "/profile/history") else "/profile"
+    return RedirectResponse(url=url, status_code=status.HTTP_303_SEE_OTHER)
+
+@web_router.get("/profile/transactions", response_class=HTMLResponse, dependencies=[db_route(pool=EXPORT_POOL)])
 async def get_transactions_page(
     request: Request,
-    user: User = Depends(get_current_user),
-    db_session: AsyncSession = Depends(get_session)
+    user: CurrentUserSchema = Depends(get_current_user),
+    db_session: AsyncSession = Depends(get_readonly_session)
 ):
     """История транзакций"""
     transactions = await BalanceCRUD.get_user_transactions(db_session, user_id=user.user_id)
@@ -216,11 +239,11 @@ async def get_transactions_page(
     })
 
 
-@web_router.get("/profile/history", response_class=HTMLResponse)
+@web_router.get("/profile/history", response_class=HTMLResponse, dependencies=[db_route(pool=EXPORT_POOL)])
 async def get_history_page(
         request: Request,
-        user: User = Depends(get_current_user),
-        db_session: AsyncSession = Depends(get_session)
+        user: CurrentUserSchema = Depends(get_current_user),
+        db_session: AsyncSession = Depends(get_readonly_session)
 ):
     """История запросов"""
     history = await MLTaskCRUD.get_history(db_session, user_id=user.user_id)
@@ -232,11 +255,11 @@ async def get_history_page(
 
 demo_model=1
 
-@web_router.post("/profile/predict")
+@web_router.post("/profile/predict", dependencies=[rate_limit("predict"), Depends(admission_control)])
 async def web_predict_handler(
         request: Request,
         input_text: str = Form(...),
-        user: User = Depends(get_current_user),
+        user: CurrentUserSchema = Depends(get_current_user),
         db_session: AsyncSession = Depends(get_session)
 ):
     """Отправка запроса в воркер"""
@@ -256,7 +279,11 @@ async def web_predict_handler(
         )
 
         # Отправка в очередь
-        await send_to_rabbit(task.task_id, validated_data.input_data, active_model.model_id)
+        priority = get_task_priority(validated_data.input_data, user.role)
+        await send_to_rabbit(
+            task.task_id, validated_data.input_data, active_model.model_id,
+            priority, user.user_id, active_model.sla_seconds
+        )
 
         return RedirectResponse(url="/profile", status_code=status.HTTP_303_SEE_OTHER)
 
@@ -266,7 +293,7 @@ async def web_predict_handler(
         #  Снова получаем данные для страницы
         history = await MLTaskCRUD.get_history(db_session, user_id=user.user_id, limit=5)
         # Получаем баланс,и мл-модель так как шаблон profile.html требует эти данные
-        user_balance = await BalanceCRUD.get_any(db_session, user.user_id)
+        user_balance = await BalanceCRUD.get_cached(db_session, user.user_id)
         active_model = await MLModelCRUD.get_first_model(db_session)
 
         # Формируем текст ошибки
@@ -0,0 +1,94 @@
+# =============================================
+# Формат сообщений очереди задач: компактный бинарный (заголовок struct + текст в UTF-8)
+# и прежний JSON. Формат сообщения определяется по content_type
+# =============================================
+import json
+import struct
+from datetime import datetime
+
+# content_type сообщений задач; версия формата записана в первом байте тела
+BINARY_CONTENT_TYPE = "application/x-ml-task"
+JSON_CONTENT_TYPE = "application/json"
+
+PAYLOAD_VERSION = 1
+
+# Заголовок версии 1 (сетевой порядок байт), дальше до конца тела - входной текст в UTF-8:
+# версия, task_id, user_id (-1 - нет), model_id, приоритет, время постановки и срок (нс с эпохи, 0 - без срока)
+_HEADER_V1 = struct.Struct("!BQqIBqq")
+
+
+def encode_task_payload(
+        task_id: int,
+        input_text: str,
+        model_id: int,
+        priority: int,
+        user_id: int | None,
+        enqueued_at_ns: int,
+        expires_at_ns: int | None,
+        payload_format: str = "binary"
+) -> tuple[bytes, str]:
+    """
+    Кодирует задачу для очереди. Возвращает тело и content_type сообщения.
+    payload_format="json" - прежний JSON-формат, который понимают и воркеры без поддержки бинарного.
+    """
+    if payload_format == "json":
+        payload = {
+            "task_id": str(task_id),
+            "user_id": user_id,
+            "features": {"input": input_text},
+            "model": model_id,
+            "priority": priority,
+            "timestamp": datetime.fromtimestamp(enqueued_at_ns / 1e9).isoformat(),
+            "timestamp_ns": enqueued_at_ns,
+            "expires_at": datetime.fromtimestamp(expires_at_ns / 1e9).isoformat() if expires_at_ns else None
+        }
+        return json.dumps(payload).encode(), JSON_CONTENT_TYPE
+
+    header = _HEADER_V1.pack(
+        PAYLOAD_VERSION, task_id, -1 if user_id is None else user_id, model_id, priority,
+        enqueued_at_ns, expires_at_ns or 0
+    )
+    return header + input_text.encode("utf-8"), BINARY_CONTENT_TYPE
+
+
+def _iso_to_ns(value: str | None) -> int | None:
+    return int(datetime.fromisoformat(value).timestamp() * 1e9) if value else None
+
+
+def decode_task_payload(body: bytes, content_type: str | None) -> dict:
+    """
+    Декодирует тело сообщения задачи в словарь с ключами task_id, user_id, model_id, priority, input,
+    enqueued_at_ns, expires_at_ns. Сообщения без content_type (старые) читаются как JSON.
+    Неизвестная версия или повреждённое тело - ValueError.
+    """
+    if content_type == BINARY_CONTENT_TYPE:
+        if not body or body[0] != PAYLOAD_VERSION:
+            raise ValueError(f"Неподдерживаемая версия сообщения задачи: {body[0] if body else None}")
+        if len(body) < _HEADER_V1.size:
+            raise ValueError("Повреждённое сообщение задачи: тело короче заголовка")
+        version, task_id, user_id, model_id, priority, enqueued_at_ns, expires_at_ns = _HEADER_V1.unpack_from(body)
+        return {
+            "task_id": task_id,
+            "user_id": None if user_id < 0 else user_id,
+            "model_id": model_id,
+            "priority": priority,
+            "input": body[_HEADER_V1.size:].decode("utf-8"),
+            "enqueued_at_ns": enqueued_at_ns,
+            "expires_at_ns": expires_at_ns or None
+        }
+
+    if content_type not in (None, JSON_CONTENT_TYPE):
+        raise ValueError(f"Неподдерживаемый формат сообщения задачи: {content_type}")
+    payload = json.loads(body)
+    try:
+        return {
+            "task_id": int(payload["task_id"]),
+            "user_id": payload.get("user_id"),
+            "model_id": payload["model"],
+            "priority": payload.get("priority", 1),
+            "input": payload["features"].get("input", ""),
+            "enqueued_at_ns": payload.get("timestamp_ns") or _iso_to_ns(payload["timestamp"]),
+            "expires_at_ns": _iso_to_ns(payload.get("expires_at"))
+        }
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Некорректное сообщение задачи: {e}")
@@ -12,6 +12,44 @@ class Settings(BaseSettings):
     DB_USER: Optional[str] = None
     DB_PASS: Optional[str] = None
     DB_NAME: Optional[str] = None
+    DB_POOL_SIZE: Optional[int] = 10  # постоянные соединения пула (все они открываются при старте)
+    DB_MAX_OVERFLOW: Optional[int] = 20  # дополнительные соединения при пиковой нагрузке
+    DB_QUERY_CACHE_SIZE: Optional[int] = 500  # кэш скомпилированных SQLAlchemy запросов
+    DB_PREPARED_STATEMENT_CACHE_SIZE: Optional[int] = 500  # кэш подготовленных asyncpg запросов на соединение
+    DB_STATEMENT_TIMEOUT_MS: Optional[int] = 5000  # лимит на один SQL-запрос по умолчанию
+    # отдельный пул для тяжёлых выгрузок (история), чтобы они не занимали соединения интерактивных запросов
+    DB_EXPORT_POOL_SIZE: Optional[int] = 2
+    DB_EXPORT_MAX_OVERFLOW: Optional[int] = 3
+    DB_EXPORT_STATEMENT_TIMEOUT_MS: Optional[int] = 30000
+    SLOW_QUERY_MS: Optional[int] = 200  # запросы дольше пишутся в лог медленных запросов
+    N_PLUS_ONE_THRESHOLD: Optional[int] = 5  # сколько одинаковых запросов за HTTP-запрос считать N+1
+
+    # кэш каталога ML-моделей
+    MODEL_CACHE_TTL_SECONDS: Optional[int] = 300
+    # кэш версий токенов (проверка отзыва JWT)
+    TOKEN_VERSION_CACHE_TTL_SECONDS: Optional[int] = 60
+    TOKEN_VERSION_CACHE_MAX_SIZE: Optional[int] = 10000
+    # кэш API-ключей
+    API_KEY_CACHE_TTL_SECONDS: Optional[int] = 60
+    API_KEY_CACHE_MAX_SIZE: Optional[int] = 10000
+    # отдельный кэш неизвестных ключей: маленький и короткий, чтобы перебор ключей не вытеснял действующие
+    API_KEY_MISS_CACHE_TTL_SECONDS: Optional[int] = 10
+    API_KEY_MISS_CACHE_MAX_SIZE: Optional[int] = 1000
+    # кэш балансов для отображения
+    BALANCE_CACHE_TTL_SECONDS: Optional[int] = 30
+    BALANCE_CACHE_MAX_SIZE: Optional[int] = 10000
+    # недавние ключи идемпотентности запуска предсказаний (быстрый ответ на повтор без запроса в БД)
+    IDEMPOTENCY_CACHE_TTL_SECONDS: Optional[int] = 600
+    IDEMPOTENCY_CACHE_MAX_SIZE: Optional[int] = 10000
+
+    # параметры реплики БД только для чтения (если DB_REPLICA_HOST не задан — все запросы идут в основную БД)
+    DB_REPLICA_HOST: Optional[str] = None
+    DB_REPLICA_PORT: Optional[int] = None
+    REPLICA_MAX_LAG_SECONDS: Optional[float] = 5.0  # при большем отставании чтение уходит в основную БД
+    REPLICA_LAG_CHECK_INTERVAL_SECONDS: Optional[float] = 1.0  # как часто перепроверять отставание реплики
+    READ_YOUR_WRITES_SECONDS: Optional[int] = 10  # сколько секунд после записи клиент читает из основной БД
+    # чтение в основной БД транзакциями SERIALIZABLE READ ONLY DEFERRABLE (без конфликтов сериализации)
+    DB_READONLY_DEFERRABLE: Optional[bool] = False
 
     APP_NAME: Optional[str] =  None
     APP_DESCRIPTION: Optional[str] =  None
@@ -28,11 +66,86 @@ class Settings(BaseSettings):
     SECRET_KEY: Optional[str] =  None
     ALGORITHM: Optional[str] =  None
     ACCESS_TOKEN_EXPIRE_MINUTES: Optional[int] =None
+    REFRESH_TOKEN_EXPIRE_DAYS: Optional[int] = 7  # срок refresh-токена, по которому выпускаются новые access-токены
+
+    # хеширование паролей
+    BCRYPT_ROUNDS: Optional[int] = 12  # стоимость bcrypt, при изменении хеши пересчитываются при входе
+    PASSWORD_HASH_WORKERS: Optional[int] = 2  # потоки пула bcrypt
+    PASSWORD_HASH_MAX_PENDING: Optional[int] = 32  # больше операций в пуле — отвечаем 503
+    PASSWORD_HASH_RETRY_AFTER_SECONDS: Optional[int] = 1  # значение заголовка Retry-After при перегрузке
+
+    # ограничение частоты запросов (token bucket): скорость в минуту и запас для всплесков
+    RATE_LIMIT_ENABLED: Optional[bool] = True
+    RATE_LIMIT_BACKEND: Optional[str] = "memory"  # memory - у каждой реплики свои корзины, postgres - общие
+    RATE_LIMIT_MAX_BUCKETS: Optional[int] = 100000  # сколько корзин держать в памяти процесса
+    # от каких адресов принимать X-Forwarded-For (адрес клиента за nginx); * - приложение доступно только через nginx
+    FORWARDED_ALLOW_IPS: Optional[str] = "*"
+    RATE_LIMIT_PREDICT_PER_MINUTE: Optional[int] = 30
+    RATE_LIMIT_PREDICT_BURST: Optional[int] = 10
+    RATE_LIMIT_LOGIN_PER_MINUTE: Optional[int] = 10
+    RATE_LIMIT_LOGIN_BURST: Optional[int] = 5
+    # вход: общий лимит на IP по всем логинам, чтобы с одного адреса нельзя было перебирать аккаунты
+    RATE_LIMIT_LOGIN_IP_PER_MINUTE: Optional[int] = 30
+    RATE_LIMIT_LOGIN_IP_BURST: Optional[int] = 15
+    RATE_LIMIT_SIGNUP_PER_MINUTE: Optional[int] = 5
+    RATE_LIMIT_SIGNUP_BURST: Optional[int] = 3
+
+    # контроль приёма задач по длине очереди ml_tasks (проверяется до списания средств)
+    ADMISSION_MAX_QUEUE_DEPTH: Optional[int] = 1000  # больше задач в очереди — новые не принимаются
+    ADMISSION_MAX_WAIT_SECONDS: Optional[int] = 120  # больше ожидаемое ожидание — новые не принимаются
+    ADMISSION_TASK_SECONDS: Optional[float] = 1.0  # среднее время обработки задачи одним воркером
+    ADMISSION_CHECK_INTERVAL_SECONDS: Optional[float] = 1.0  # как часто перечитывать длину очереди
+
+    # приоритеты задач в очереди ml_tasks (изменение TASK_MAX_PRIORITY требует пересоздания очереди)
+    TASK_MAX_PRIORITY: Optional[int] = 3
+    TASK_SHORT_INPUT_CHARS: Optional[int] = 20  # такие короткие запросы обрабатываются раньше длинных
+    WORKER_METRICS_LOG_INTERVAL_SECONDS: Optional[int] = 60  # как часто воркер пишет метрики в лог
+    # сколько задач воркер берёт из очереди одновременно (одинаковые среди них считаются один раз)
+    WORKER_PREFETCH_COUNT: Optional[int] = 10
+    # разбор задачи дольше TASK_TIMEOUT_SECONDS прерывается, задача завершается ошибкой с возвратом средств
+    TASK_TIMEOUT_SECONDS: Optional[float] = 30.0
+    ANALYSIS_PROCESSES: Optional[int] = 1  # процессы разбора; 0 - в потоке (зависший разбор нельзя остановить)
+    # сколько воркер при остановке (SIGTERM) ждёт задачи в работе; должно быть меньше stop_grace_period в docker-compose
+    WORKER_SHUTDOWN_GRACE_SECONDS: Optional[float] = 25.0
+    # автомасштабирование воркеров (ml_worker.supervisor): число воркеров от длины очереди и возраста задач
+    WORKER_AUTOSCALE_MIN: Optional[int] = 1
+    WORKER_AUTOSCALE_MAX: Optional[int] = 4
+    WORKER_AUTOSCALE_TARGET_WAIT_SECONDS: Optional[float] = 10.0  # к какому ожиданию в очереди стремиться
+    WORKER_AUTOSCALE_DOWN_UTILIZATION: Optional[float] = 0.5  # уменьшать, только если воркеры заняты меньше чем на долю
+    WORKER_AUTOSCALE_DOWN_COOLDOWN_SECONDS: Optional[int] = 60  # пауза между уменьшениями и после увеличения
+    WORKER_AUTOSCALE_INTERVAL_SECONDS: Optional[int] = 5
+    # справедливость между пользователями: сверх лимита задач в работе задачи пользователя откладываются
+    TASK_MAX_IN_FLIGHT_PER_USER: Optional[int] = 2
+    # через сколько отложенная задача возвращается в очередь (через запятую): задержка растёт с каждым
+    # откладыванием задачи, последняя действует для всех следующих
+    TASK_DEFER_DELAYS_MS: Optional[str] = "2000,5000,15000,60000"
+    # сколько пользователей сверх лимита показывать в метрике task_over_quota_wait_seconds (с меткой user)
+    WORKER_OVER_QUOTA_USERS_TRACKED: Optional[int] = 20
+    # задержки повторов задачи после ошибки (через запятую); после последней задача уходит в ml_tasks.dead
+    TASK_RETRY_DELAYS_MS: Optional[str] = "1000,10000,60000"
+    # истёкшие задачи (SLA модели) закрываются с возвратом средств пачками
+    TASK_EXPIRED_BATCH_SIZE: Optional[int] = 100
+    TASK_EXPIRED_FLUSH_SECONDS: Optional[float] = 1.0  # как часто закрывать неполную пачку
+    # аренда задач воркерами: без heartbeat дольше TASK_LEASE_SECONDS задача считается брошенной
+    TASK_LEASE_SECONDS: Optional[int] = 60
+    TASK_HEARTBEAT_SECONDS: Optional[int] = 15
+    TASK_REAPER_INTERVAL_SECONDS: Optional[int] = 30  # как часто искать брошенные задачи
+    TASK_MAX_RECLAIMS: Optional[int] = 2  # сколько раз брошенная задача возвращается в очередь до возврата средств
+    # формат сообщений задач: binary (компактный) или json (пока работают воркеры, не знающие binary)
+    TASK_PAYLOAD_FORMAT: Optional[str] = "binary"
 
     @property
     def DATABASE_URL(self):
         return f'postgresql+asyncpg://{self.DB_USER}:{self.DB_PASS}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}'
 
+    @property
+    def DATABASE_REPLICA_URL(self) -> Optional[str]:
+        """Строка подключения к реплике для чтения. None, если реплика не настроена"""
+        if not self.DB_REPLICA_HOST:
+            return None
+        port = self.DB_REPLICA_PORT or self.DB_PORT
+        return f'postgresql+asyncpg://{self.DB_USER}:{self.DB_PASS}@{self.DB_REPLICA_HOST}:{port}/{self.DB_NAME}'
+
     @property
     def RABBITMQ_URL(self) -> str:
         """Формирует строку подключения для aio-pika"""
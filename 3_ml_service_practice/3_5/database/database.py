@@ -1,8 +1,12 @@
-from sqlalchemy import text
-from sqlalchemy.orm import registry
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy import text, event, Engine
+from sqlalchemy.orm import registry, Session
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession, async_sessionmaker
+from contextvars import ContextVar
+import asyncio
 import logging
+import time
 from config import get_settings
+from database.instrumentation import instrument_engine
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -13,21 +17,264 @@ mapper_registry = registry()
 metadata = mapper_registry.metadata
 
 # --- 2. Фабрика движка
-def get_engine():
+# Пулы соединений: тяжёлые выгрузки не должны занимать соединения, нужные интерактивным запросам
+INTERACTIVE_POOL = "interactive"
+EXPORT_POOL = "export"
+
+
+def create_engine_for(url: str, pool: str = INTERACTIVE_POOL, name: str = "primary"):
+    """
+    Создаёт движок с настройками пула и кэшей запросов из Settings.
+    Лимит statement_timeout по умолчанию задаётся при подключении и не стоит лишних запросов.
+    name - имя движка в метриках SQL-запросов и пула.
+    """
+    settings = get_settings()
+    if pool == EXPORT_POOL:
+        pool_size, max_overflow = settings.DB_EXPORT_POOL_SIZE, settings.DB_EXPORT_MAX_OVERFLOW
+    else:
+        pool_size, max_overflow = settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW
+    engine = create_async_engine(
+        url,
+        echo=settings.DEBUG,
+        pool_pre_ping=True,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+        connect_args={
+            "prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE,
+            "server_settings": {"statement_timeout": str(settings.DB_STATEMENT_TIMEOUT_MS)}
+        }
+    )
+    instrument_engine(engine, name=f"{name}:{pool}")
+    return engine
+
+
+def get_engine(pool: str = INTERACTIVE_POOL):
     """
-    Возвращает один и тот же экземпляр движка.
+    Возвращает один и тот же экземпляр движка для пула pool.
     Создаётся при первом вызове.
     """
-    if not hasattr(get_engine, "_engine"):
-        settings = get_settings()
-        get_engine._engine = create_async_engine(
-            settings.DATABASE_URL,
-            echo=settings.DEBUG,
-            pool_pre_ping=True,
-            pool_size=10,
-            max_overflow=20
-        )
-    return get_engine._engine
+    if not hasattr(get_engine, "_engines"):
+        get_engine._engines = {}
+    if pool not in get_engine._engines:
+        get_engine._engines[pool] = create_engine_for(get_settings().DATABASE_URL, pool)
+    return get_engine._engines[pool]
+
+
+# --- 2.1 Движок реплики для чтения
+def get_replica_engine(pool: str = INTERACTIVE_POOL):
+    """
+    Возвращает один и тот же экземпляр движка реплики для пула pool.
+    Если реплика не настроена (DB_REPLICA_HOST пуст) — возвращает None.
+    """
+    if not hasattr(get_replica_engine, "_engines"):
+        get_replica_engine._engines = {}
+    if pool not in get_replica_engine._engines:
+        replica_url = get_settings().DATABASE_REPLICA_URL
+        get_replica_engine._engines[pool] = create_engine_for(replica_url, pool, name="replica") if replica_url else None
+    return get_replica_engine._engines[pool]
+
+
+# Отставание реплики: 0, если всё полученное WAL уже применено (иначе простой основной БД выглядел бы как отставание)
+REPLICA_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+async def get_replica_lag() -> float:
+    """
+    Отставание реплики в секундах.
+    Значение кэшируется на REPLICA_LAG_CHECK_INTERVAL_SECONDS, чтобы не проверять его на каждый запрос.
+    Недоступная реплика считается бесконечно отстающей.
+    """
+    settings = get_settings()
+    now = time.monotonic()
+    checked_at, lag = getattr(get_replica_lag, "_cached", (None, None))
+    if checked_at is not None and now - checked_at < settings.REPLICA_LAG_CHECK_INTERVAL_SECONDS:
+        return lag
+    # Сразу сдвигаем время проверки, чтобы параллельные запросы не проверяли реплику одновременно
+    get_replica_lag._cached = (now, lag if lag is not None else 0.0)
+    try:
+        async with get_replica_engine().connect() as conn:
+            lag = float((await conn.execute(REPLICA_LAG_QUERY)).scalar() or 0)
+    except Exception as e:
+        logger.warning(f"Не удалось проверить отставание реплики: {e}")
+        lag = float("inf")
+    get_replica_lag._cached = (now, lag)
+    return lag
+
+
+# --- 2.2 Read-your-writes: после записи клиент какое-то время читает из основной БД
+READ_YOUR_WRITES_COOKIE = "db_last_write"
+
+# Состояние текущего HTTP-запроса: {"sticky": читать из основной БД, "wrote": в запросе была запись}
+_write_tracking: ContextVar[dict | None] = ContextVar("write_tracking", default=None)
+
+
+def start_write_tracking(last_write_cookie: str | None) -> dict:
+    """
+    Начинает отслеживание записей для HTTP-запроса (вызывается из middleware).
+    last_write_cookie - значение куки с временем последней записи клиента.
+    """
+    settings = get_settings()
+    sticky = False
+    if last_write_cookie:
+        try:
+            sticky = time.time() - float(last_write_cookie) < settings.READ_YOUR_WRITES_SECONDS
+        except ValueError:
+            sticky = False
+    state = {"sticky": sticky, "wrote": False}
+    _write_tracking.set(state)
+    return state
+
+
+def _mark_write():
+    """Запись в рамках HTTP-запроса: дальнейшее чтение этого клиента идёт в основную БД"""
+    state = _write_tracking.get()
+    if state is not None:
+        state["wrote"] = True
+        state["sticky"] = True
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_flush(session, flush_context):
+    """Запись изменённых ORM-объектов"""
+    _mark_write()
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_dml(orm_execute_state):
+    """Запись через session.execute(update()/insert()/delete()) — flush её не видит (отмена задачи, возвраты)"""
+    if orm_execute_state.is_update or orm_execute_state.is_insert or orm_execute_state.is_delete:
+        _mark_write()
+
+
+def get_readonly_engine(engine, deferrable: bool = False):
+    """
+    Вариант движка (с общим пулом соединений), который открывает транзакции как BEGIN READ ONLY.
+    С deferrable=True транзакция SERIALIZABLE READ ONLY DEFERRABLE: она ждёт безопасный снимок и
+    не может быть прервана конфликтом сериализации. На реплике (hot standby) SERIALIZABLE запрещён.
+    """
+    if not hasattr(get_readonly_engine, "_engines"):
+        get_readonly_engine._engines = {}
+    key = (engine, deferrable)
+    if key not in get_readonly_engine._engines:
+        options = {"postgresql_readonly": True}
+        if deferrable:
+            options.update(isolation_level="SERIALIZABLE", postgresql_deferrable=True)
+        get_readonly_engine._engines[key] = engine.execution_options(**options)
+    return get_readonly_engine._engines[key]
+
+
+async def get_read_engine(pool: str = INTERACTIVE_POOL):
+    """
+    Выбор движка для запросов только на чтение.
+    Основная БД используется, если реплика не настроена, клиент недавно писал или реплика отстаёт.
+    """
+    primary_engine = get_readonly_engine(get_engine(pool), deferrable=get_settings().DB_READONLY_DEFERRABLE)
+    replica_engine = get_replica_engine(pool)
+    if replica_engine is None:
+        return primary_engine
+
+    state = _write_tracking.get()
+    if state is not None and state["sticky"]:
+        return primary_engine
+
+    lag = await get_replica_lag()
+    if lag > get_settings().REPLICA_MAX_LAG_SECONDS:
+        logger.warning(f"Отставание реплики {lag:.1f} с, чтение переключено на основную БД")
+        return primary_engine
+    return get_readonly_engine(replica_engine)
+
+
+# --- 2.3 Параметры маршрута: лимит времени запросов, пул соединений, отмена при отключении клиента
+# Параметры текущего маршрута: {"statement_timeout_ms", "pool", "request", "reading"}
+_route_options: ContextVar[dict | None] = ContextVar("route_options", default=None)
+
+# Как часто проверять, не отключился ли клиент, пока выполняется запрос на чтение
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+def db_route(statement_timeout_ms: int | None = None, pool: str = INTERACTIVE_POOL):
+    """
+    Метаданные маршрута для работы с БД, передаются в dependencies=[...] декоратора маршрута.
+    statement_timeout_ms - лимит на один SQL-запрос (SET LOCAL statement_timeout в каждой транзакции),
+    для EXPORT_POOL по умолчанию DB_EXPORT_STATEMENT_TIMEOUT_MS.
+    pool - пул соединений, EXPORT_POOL для тяжёлых выгрузок.
+    Если клиент отключился, выполняющийся запрос на чтение отменяется.
+    """
+    # FastAPI импортируется здесь, чтобы воркер (без FastAPI) мог использовать этот модуль
+    from fastapi import Depends, Request
+
+    if statement_timeout_ms is None and pool == EXPORT_POOL:
+        statement_timeout_ms = get_settings().DB_EXPORT_STATEMENT_TIMEOUT_MS
+
+    async def apply_db_route(request: Request):
+        _route_options.set({
+            "statement_timeout_ms": statement_timeout_ms,
+            "pool": pool,
+            "request": request,
+            "reading": None  # (движок, pid процесса PostgreSQL) запроса на чтение, который сейчас выполняется
+        })
+
+    return Depends(apply_db_route)
+
+
+@event.listens_for(Session, "after_begin")
+def _set_statement_timeout(session, transaction, connection):
+    """Лимит маршрута действует только внутри транзакции (SET LOCAL) и не переходит на другие запросы через пул"""
+    options = _route_options.get()
+    if options is not None and options["statement_timeout_ms"] is not None:
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(options['statement_timeout_ms'])}")
+
+
+def _is_route_read(conn) -> bool:
+    """Запрос маршрута на чтение (движок get_readonly_engine): только такие отменяются при отключении клиента"""
+    return _route_options.get() is not None and conn.get_execution_options().get("postgresql_readonly", False)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _statement_started(conn, cursor, statement, parameters, context, executemany):
+    if _is_route_read(conn):
+        get_server_pid = getattr(conn.connection.driver_connection, "get_server_pid", None)
+        _route_options.get()["reading"] = (conn.engine, get_server_pid()) if get_server_pid else None
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _statement_finished(conn, cursor, statement, parameters, context, executemany):
+    if _is_route_read(conn):
+        _route_options.get()["reading"] = None
+
+
+@event.listens_for(Engine, "handle_error")
+def _statement_failed(exception_context):
+    conn = exception_context.connection
+    if conn is not None and _is_route_read(conn):
+        _route_options.get()["reading"] = None
+
+
+async def _cancel_on_disconnect(options: dict):
+    """
+    Проверяет (request.is_disconnected), не отключился ли клиент, и если в этот момент выполняется SQL -
+    отменяет его на сервере (pg_cancel_backend). Задача запроса не отменяется: отмена чужой задачи
+    ломает middleware на anyio (BaseHTTPMiddleware), а ошибку отменённого запроса уже некому показать.
+    Тело запроса не читается: FastAPI вычитывает его до зависимостей.
+    """
+    # собственный запрос отмены не должен учитываться как запрос маршрута
+    _route_options.set(None)
+    request = options["request"]
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+    reading = options["reading"]
+    if reading is not None:
+        # отмена - на том же сервере (основная БД или реплика), где выполняется запрос
+        sync_engine, pid = reading
+        async with AsyncEngine(sync_engine).connect() as conn:
+            await conn.execute(text("SELECT pg_cancel_backend(:pid)"), {"pid": pid})
+        logger.warning(f"Клиент отключился, запрос к БД отменён: {request.url.path}")
 
 
 # --- 3. Фабрика сессий
@@ -62,6 +309,26 @@ async def get_session():
         await session.close()
 
 
+async def get_readonly_session():
+    """
+    Генератор сессии только для чтения (реплика, если она настроена и не отстаёт).
+    Транзакция открывается одной командой BEGIN READ ONLY, попытка записи завершится ошибкой БД.
+    Ничего не коммитит: при закрытии транзакция откатывается, соединение сразу возвращается в пул.
+    """
+    options = _route_options.get()
+    pool = options["pool"] if options is not None else INTERACTIVE_POOL
+    session = get_session_local()(bind=await get_read_engine(pool))
+    watcher = None
+    if options is not None:
+        watcher = asyncio.create_task(_cancel_on_disconnect(options))
+    try:
+        yield session
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        await session.close()
+
+
 # --- 5. Инициализация БД: принимает движок как аргумент
 async def init_db(drop_all: bool = False, engine=None):
     """
@@ -83,3 +350,22 @@ async def init_db(drop_all: bool = False, engine=None):
 
     logger.info("БД инициализирована.")
 
+
+# --- 6. Прогрев пула соединений
+async def warm_up_pool(run_queries, engine=None):
+    """
+    Открывает сразу DB_POOL_SIZE соединений и на каждом выполняет горячие запросы,
+    чтобы asyncpg заранее подготовил (prepare) их, а SQLAlchemy скомпилировал и закэшировал.
+    run_queries - async функция, принимающая сессию. Если engine не передан — использует get_engine().
+    """
+    engine = get_readonly_engine(engine or get_engine())
+
+    async def warm_up_connection():
+        # Соединения держатся одновременно, поэтому пул создаёт все DB_POOL_SIZE штук
+        async with engine.connect() as conn:
+            async with get_session_local()(bind=conn) as session:
+                await run_queries(session)
+
+    started = time.monotonic()
+    await asyncio.gather(*(warm_up_connection() for _ in range(get_settings().DB_POOL_SIZE)))
+    logger.info(f"Пул прогрет: {get_settings().DB_POOL_SIZE} соединений за {time.monotonic() - started:.2f} с")
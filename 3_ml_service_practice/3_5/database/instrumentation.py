@@ -0,0 +1,141 @@
+# =============================================
+# Инструментирование SQL: время запросов, счётчик запросов на HTTP-запрос,
+# ожидание соединения из пула, лог медленных запросов, поиск N+1
+# =============================================
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import Counter
+import logging
+import threading
+import time
+from config import get_settings
+from metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# Статистика текущего HTTP-запроса: {"count", "time", "statements", "checkout_started", "n_plus_one"}
+_query_stats: ContextVar[dict | None] = ContextVar("query_stats", default=None)
+
+# Активные бюджеты запросов (assert_query_budget), считают запросы из любых потоков
+_budgets = []
+_budgets_lock = threading.Lock()
+
+
+def start_query_stats() -> dict:
+    """
+    Начинает подсчёт SQL-запросов для HTTP-запроса (вызывается из middleware).
+    """
+    stats = {"count": 0, "time": 0.0, "statements": Counter(), "checkout_started": None, "n_plus_one": set()}
+    _query_stats.set(stats)
+    return stats
+
+
+def _short(statement: str, limit: int = 300) -> str:
+    """SQL в одну строку для логов"""
+    statement = " ".join(statement.split())
+    return statement if len(statement) <= limit else statement[:limit] + "..."
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_started"].pop()
+    settings = get_settings()
+    metrics.observe("db_query_seconds", duration)
+
+    if duration * 1000 > settings.SLOW_QUERY_MS:
+        metrics.inc("db_slow_queries")
+        logger.warning(f"Медленный SQL-запрос ({duration * 1000:.0f} мс): {_short(statement)}")
+
+    stats = _query_stats.get()
+    if stats is not None:
+        stats["count"] += 1
+        stats["time"] += duration
+        stats["statements"][statement] += 1
+        # Один и тот же запрос много раз за HTTP-запрос — почти всегда N+1 (запрос в цикле)
+        if stats["statements"][statement] == settings.N_PLUS_ONE_THRESHOLD:
+            stats["n_plus_one"].add(statement)
+            metrics.inc("db_n_plus_one_detected")
+            logger.warning(
+                f"Возможен N+1: запрос выполнен {settings.N_PLUS_ONE_THRESHOLD} раз за один HTTP-запрос: "
+                f"{_short(statement)}"
+            )
+
+    with _budgets_lock:
+        for budget in _budgets:
+            budget["count"] += 1
+            budget["statements"].append(statement)
+
+
+def _handle_error(exception_context):
+    # Запрос упал — убираем его время старта, чтобы не сбить следующие замеры
+    started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+    if started and exception_context.cursor is not None:
+        started.pop()
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _remember_checkout_start(orm_execute_state):
+    """Сессия без транзакции сейчас возьмёт соединение из пула — засекаем начало ожидания"""
+    stats = _query_stats.get()
+    if stats is not None and not orm_execute_state.session.in_transaction():
+        stats["checkout_started"] = time.perf_counter()
+
+
+def instrument_engine(engine, name: str):
+    """
+    Подключает обработчики событий к движку: время каждого запроса и загрузка пула.
+    name - имя движка в метриках (например, primary:interactive).
+    """
+    sync_engine = engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
+
+    pool = sync_engine.pool
+    capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_out = pool.checkedout()
+        metrics.set("db_pool_checked_out", checked_out, engine=name)
+        metrics.set("db_pool_saturation", round(checked_out / capacity, 3), engine=name)
+        if checked_out >= capacity:
+            metrics.inc("db_pool_exhausted", engine=name)
+
+        stats = _query_stats.get()
+        if stats is not None and stats["checkout_started"] is not None:
+            metrics.observe("db_pool_wait_seconds", time.perf_counter() - stats["checkout_started"], engine=name)
+            stats["checkout_started"] = None
+
+    def on_checkin(dbapi_connection, connection_record):
+        # событие приходит до возврата соединения в пул, поэтому оно ещё считается выданным
+        metrics.set("db_pool_checked_out", max(pool.checkedout() - 1, 0), engine=name)
+
+    event.listen(pool, "checkout", on_checkout)
+    event.listen(pool, "checkin", on_checkin)
+
+
+@contextmanager
+def assert_query_budget(max_queries: int):
+    """
+    Помощник для тестов: падает с AssertionError, если внутри блока выполнено больше max_queries
+    SQL-запросов. Считает запросы из любых потоков, поэтому работает и с TestClient.
+
+        with assert_query_budget(3):
+            client.get("/profile")
+    """
+    budget = {"count": 0, "statements": []}
+    with _budgets_lock:
+        _budgets.append(budget)
+    try:
+        yield budget
+    finally:
+        with _budgets_lock:
+            _budgets.remove(budget)
+    if budget["count"] > max_queries:
+        statements = "\n".join(_short(statement) for statement in budget["statements"])
+        raise AssertionError(f"Выполнено {budget['count']} SQL-запросов при бюджете {max_queries}:\n{statements}")
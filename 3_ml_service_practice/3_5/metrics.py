@@ -0,0 +1,64 @@
+# =============================================
+# Метрики приложения в памяти процесса (счётчики, значения, наблюдения)
+# =============================================
+import threading
+
+
+def _metric_key(name: str, labels: dict) -> str:
+    """Ключ метрики вида name{label=value,...}"""
+    if not labels:
+        return name
+    labels_str = ",".join(f"{key}={value}" for key, value in sorted(labels.items()))
+    return f"{name}{{{labels_str}}}"
+
+
+class Metrics:
+    """
+    Простой потокобезопасный реестр метрик процесса.
+    inc - счётчик, set - текущее значение, observe - наблюдения (количество, сумма, максимум).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._observations = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def remove(self, name: str, **labels):
+        """Удаляет значение (set), например, когда объект, который оно описывает, больше не отслеживается"""
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges.pop(key, None)
+
+    def observe(self, name: str, value: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            observation = self._observations.setdefault(key, {"count": 0, "sum": 0.0, "max": 0.0})
+            observation["count"] += 1
+            observation["sum"] += value
+            observation["max"] = max(observation["max"], value)
+
+    def snapshot(self) -> dict:
+        """Копия всех метрик, среднее для наблюдений считается здесь"""
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "observations": {
+                    key: {**value, "avg": value["sum"] / value["count"]}
+                    for key, value in self._observations.items()
+                }
+            }
+
+
+# Один реестр на процесс
+metrics = Metrics()
@@ -0,0 +1,83 @@
+# =============================================
+# Выполнение разбора с ограничением по времени: зависший разбор не должен занимать воркер бесконечно
+# =============================================
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from ml_worker.model import load_model
+from metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class AnalysisTimeout(Exception):
+    """Разбор не уложился в отведённое время"""
+
+
+class AnalysisPool:
+    """
+    Пул, в котором выполняется разбор, со сроком timeout секунд на задачу.
+    processes > 0 - пул процессов: процесс, превысивший срок, убивается, и пул создаётся заново.
+    processes == 0 - один поток: по истечении срока задача снимается, а пул заменяется новым,
+    но остановить поток нельзя, и он досчитывает зависший разбор в фоне.
+    Срок отсчитывается с начала выполнения, а не с постановки в очередь пула: задач в пул
+    отдаётся не больше, чем в нём процессов.
+    """
+    def __init__(self, processes: int, timeout: float):
+        self.processes = processes
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max(processes, 1))
+        self._generation = 0  # номер пула, растёт при каждом пересоздании
+        self._executor = self._create_executor()
+
+    def _create_executor(self):
+        if self.processes == 0:
+            return ThreadPoolExecutor(max_workers=1, thread_name_prefix="analysis")
+        # spawn, а не fork: у воркера уже есть потоки и открытые соединения, копировать их в дочерний процесс нельзя
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_model
+        )
+
+    def _restart(self, generation: int):
+        """Заменяет пул новым (если его ещё не заменили) и убивает процессы старого"""
+        if generation != self._generation:
+            return
+        self._generation += 1
+        old, self._executor = self._executor, self._create_executor()
+        self._stop(old)
+        metrics.inc("analysis_pool_restarts")
+
+    @staticmethod
+    def _stop(executor):
+        # у ProcessPoolExecutor нет публичного способа остановить выполняющуюся задачу
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        """Останавливает пул при остановке воркера; недосчитанные разборы прерываются"""
+        self._stop(self._executor)
+
+    async def run(self, func, *args):
+        """Выполняет func(*args) в пуле. Не уложилась в срок - AnalysisTimeout"""
+        async with self._slots:
+            while True:
+                generation = self._generation
+                future = asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+                try:
+                    return await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Разбор не уложился в {self.timeout} с, пул разбора перезапускается")
+                    self._restart(generation)
+                    raise AnalysisTimeout(f"Превышено время обработки ({self.timeout:g} с)")
+                except BrokenProcessPool:
+                    if generation != self._generation:
+                        # пул убит из-за чужой зависшей задачи — выполняем эту в новом пуле
+                        continue
+                    # процесс умер сам (например, не хватило памяти) — пересоздаём пул, задача упала
+                    self._restart(generation)
+                    raise
@@ -0,0 +1,83 @@
+# =============================================
+# Обработка сообщений, отброшенных очередью ml_tasks:
+# истёкшие задачи закрываются пачками с возвратом средств, остальные переносятся в ml_tasks.dead
+# =============================================
+import asyncio
+import logging
+import time
+from aio_pika import IncomingMessage
+from app.broker import get_channel, copy_message, TASK_DEAD_QUEUE
+from app.task_payload import decode_task_payload
+from app.crud.ml_task import MLTaskCRUD
+from database.database import get_session_local
+from metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+EXPIRED_REASON = "Истёк срок ожидания в очереди"
+
+
+def is_expired(payload: dict) -> bool:
+    """Задача не была взята в работу до своего срока (SLA модели); payload - decode_task_payload"""
+    expires_at_ns = payload["expires_at_ns"]
+    return expires_at_ns is not None and time.time_ns() >= expires_at_ns
+
+
+class ExpiredTasks:
+    """
+    Копит истёкшие задачи и закрывает их пачками: один MLTaskCRUD.refund_many на пачку
+    вместо отдельной транзакции на каждую задачу. Сообщения подтверждаются после возврата средств,
+    поэтому канал потребителя должен разрешать не меньше batch_size неподтверждённых сообщений.
+    """
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self._pending = []  # (сообщение, task_id)
+        self._lock = asyncio.Lock()
+
+    async def on_message(self, message: IncomingMessage):
+        try:
+            payload = decode_task_payload(message.body, message.content_type)
+        except ValueError as e:
+            # Нечитаемое сообщение так и осталось бы неподтверждённым — переносим как есть в очередь упавших
+            logger.error(f"Не удалось разобрать отброшенное сообщение задачи: {e}")
+            await self._dead_letter(message)
+            return
+        if not is_expired(payload):
+            # Сообщение отклонено воркером из-за ошибки — переносим в очередь упавших для разбора и replay
+            await self._dead_letter(message)
+            return
+        self._pending.append((message, payload["task_id"]))
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+
+    @staticmethod
+    async def _dead_letter(message: IncomingMessage):
+        channel = await get_channel()
+        await channel.default_exchange.publish(copy_message(message), routing_key=TASK_DEAD_QUEUE)
+        await message.ack()
+        metrics.inc("task_dead_lettered")
+
+    async def flush(self):
+        """Возвращает деньги за накопленные задачи и подтверждает их сообщения"""
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                async with get_session_local()() as db_session:
+                    refunded = await MLTaskCRUD.refund_many(db_session, [task_id for _, task_id in batch], EXPIRED_REASON)
+            except Exception as e:
+                logger.error(f"Не удалось вернуть средства за истёкшие задачи: {e}")
+                for message, _ in batch:
+                    await message.nack(requeue=True)
+                return
+            for message, _ in batch:
+                await message.ack()
+            metrics.inc("task_expired", len(batch))
+            logger.info(f"Истёкших задач: {len(batch)}, возвращены средства за {refunded}")
+
+    async def run(self, interval: float):
+        """Периодически закрывает неполную пачку"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
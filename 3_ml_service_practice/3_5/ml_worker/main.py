@@ -3,15 +3,22 @@
 # =============================================
 import uuid
 import asyncio
-import json
-import re
 import os
+import signal
 import sys
 sys.path.append(os.getcwd())
-from aio_pika import connect, IncomingMessage
+from aio_pika import IncomingMessage
+from app.broker import get_connection, get_channel, copy_message, declare_task_queue, declare_deferred_queues, declare_retry_queues
+from app.broker import declare_expired_queue, close_connection, TASK_DEAD_QUEUE, TASK_EXPIRED_QUEUE, ATTEMPT_HEADER, DEFER_HEADER
+from ml_worker.expired import ExpiredTasks, is_expired
+from ml_worker.reaper import run_reaper
+from ml_worker.single_flight import SingleFlight
+from ml_worker.analysis_pool import AnalysisPool, AnalysisTimeout
+from ml_worker.model import load_model, normalize_text, analyze_text
 from app.crud.ml_task import MLTaskCRUD
+from app.task_payload import decode_task_payload
 from app.models.enums import TaskStatus
-from database.database import get_session_local
+from database.database import get_session_local, get_engine
 import logging
 from config import get_settings
 # необходим импорт моделей, чтобы SQLAlchemy знал о связях (Relationship)
@@ -20,13 +27,10 @@ from app.models.balance import Balance
 from app.models.ml_task import MLTask
 from app.models.ml_model import MLModel
 from app.models.transaction import Transaction
-import pymorphy3 # библиотека, которая выполняет роль ML-модели
-from ml_worker.dictionary import RUS_LABELS, ATTRIBUTES_ORDER
 import random
-
-
-# Инициализируем библиотеку один раз при старте воркера
-morph = pymorphy3.MorphAnalyzer()
+import time
+from collections import OrderedDict
+from metrics import metrics
 
 
 # Генерируем короткий ID для текущего запуска
@@ -38,92 +42,301 @@ logging.basicConfig(
 )
 logger = logging.getLogger(WORKER_ID)
 
+# Одинаковые задачи, которые сейчас считаются
+single_flight = SingleFlight()
+
+# Обработчики сообщений, которые сейчас выполняются (их дожидается остановка воркера)
+in_flight = set()
+
+# Пользователи сверх лимита задач в работе, для которых есть метрика task_over_quota_wait_seconds{user=...}.
+# Не больше WORKER_OVER_QUOTA_USERS_TRACKED: дольше всех не откладывавшийся пользователь вытесняется
+over_quota_users = OrderedDict()
+
+
+def track_over_quota(user_id: int, queue_wait: float):
+    """Сколько ждёт отложенная задача пользователя сверх лимита (метрика с меткой user, число рядов ограничено)"""
+    over_quota_users[user_id] = None
+    over_quota_users.move_to_end(user_id)
+    metrics.set("task_over_quota_wait_seconds", queue_wait, user=user_id)
+    while len(over_quota_users) > get_settings().WORKER_OVER_QUOTA_USERS_TRACKED:
+        evicted, _ = over_quota_users.popitem(last=False)
+        metrics.remove("task_over_quota_wait_seconds", user=evicted)
+
+
+def untrack_over_quota(user_id: int):
+    """Задача пользователя взята в работу — он больше не сверх лимита"""
+    if user_id in over_quota_users:
+        del over_quota_users[user_id]
+        metrics.remove("task_over_quota_wait_seconds", user=user_id)
+
+
+async def defer_task(message: IncomingMessage, user_id: int, queue_wait: float):
+    """
+    Откладывает задачу пользователя, у которого уже TASK_MAX_IN_FLIGHT_PER_USER задач в работе:
+    копия сообщения уходит в очередь отложенных и возвращается в ml_tasks через задержку, которая растёт
+    с числом откладываний задачи (TASK_DEFER_DELAYS_MS), а воркер тем временем берёт задачи других пользователей.
+    """
+    deferrals = (message.headers or {}).get(DEFER_HEADER, 0)
+    deferred_queues = process_task.deferred_queues
+    headers = {**(message.headers or {}), DEFER_HEADER: deferrals + 1}
+    channel = await get_channel()
+    await channel.default_exchange.publish(
+        copy_message(message, headers), routing_key=deferred_queues[min(deferrals, len(deferred_queues) - 1)]
+    )
+    metrics.inc("task_deferred")
+    track_over_quota(user_id, queue_wait)
+    logger.info(f"Задача пользователя {user_id} отложена ({deferrals + 1}-й раз): лимит задач в работе исчерпан")
+
+
+async def keep_lease(task_id: int):
+    """Heartbeat: продлевает аренду задачи, пока воркер её считает"""
+    settings = get_settings()
+    while True:
+        await asyncio.sleep(settings.TASK_HEARTBEAT_SECONDS)
+        try:
+            async with get_session_local()() as db_session:
+                renewed = await MLTaskCRUD.heartbeat(db_session, task_id, WORKER_ID, settings.TASK_LEASE_SECONDS)
+                await db_session.commit()
+                if not renewed:
+                    logger.warning(f"Аренда задачи №{task_id} потеряна: задачу забрал reaper")
+                    return
+        except Exception as e:
+            logger.warning(f"Не удалось продлить аренду задачи №{task_id}: {e}")
+
+
+async def handle_failure(message: IncomingMessage, db_session, task_id: int, error: Exception):
+    """
+    Ошибка обработки: пока есть попытки, задача уходит в очередь повтора с нарастающей задержкой
+    (кратковременный сбой БД не превращается в FAILED). После последней попытки — возврат средств,
+    статус FAILED и копия сообщения в ml_tasks.dead (её можно перезапустить командой replay_dead).
+    """
+    attempt = (message.headers or {}).get(ATTEMPT_HEADER, 0)
+    retry_queues = process_task.retry_queues
+    channel = await get_channel()
+    headers = {**(message.headers or {}), ATTEMPT_HEADER: attempt + 1}
+
+    if attempt < len(retry_queues):
+        await channel.default_exchange.publish(copy_message(message, headers), routing_key=retry_queues[attempt])
+        metrics.inc("task_retried", attempt=attempt + 1)
+        logger.warning(f"Ошибка задачи {task_id} (попытка {attempt + 1}): {error}. Задача будет повторена")
+        try:
+            await MLTaskCRUD.release(db_session, task_id)
+        except Exception as e:
+            # повтор всё равно заберёт задачу (claim с is_retry)
+            logger.warning(f"Не удалось вернуть задачу {task_id} в ожидание: {e}")
+        return
+
+    logger.error(f" Критическая ошибка задачи {task_id} после {attempt + 1} попыток: {error}")
+    # Возвращаем деньги и меняем статус на FAILED
+    # Внутри refund создаст транзакцию REFUND и прибавит деньги к балансу
+    await MLTaskCRUD.refund(db_session, task_id, reason=str(error))
+    await db_session.commit()
+    headers["x-error"] = str(error)[:500]
+    await channel.default_exchange.publish(copy_message(message, headers), routing_key=TASK_DEAD_QUEUE)
+    metrics.inc("task_dead_lettered")
+
+
+async def consume_task(message: IncomingMessage):
+    """Обработчик сообщений очереди задач: учитывает задачи в работе, чтобы остановка их дождалась"""
+    task = asyncio.current_task()
+    in_flight.add(task)
+    try:
+        await process_task(message)
+    finally:
+        in_flight.discard(task)
+
 
 async def process_task(message: IncomingMessage):
     """Логика работы воркера"""
-    async with message.process():
-        payload = json.loads(message.body)
-        task_id = int(payload['task_id'])
-        user_text = payload['features'].get('input', '')
+    # ignore_processed: при остановке воркера сообщение возвращается в очередь явно (nack)
+    async with message.process(ignore_processed=True):
+        # бинарный или JSON-формат — по content_type (app.task_payload)
+        payload = decode_task_payload(message.body, message.content_type)
+        task_id = payload['task_id']
+        user_text = payload['input']
+        user_id = payload['user_id']
+        priority = message.priority or 0
+        settings = get_settings()
 
+        if is_expired(payload):
+            # Истёкшую задачу не считаем: её закроет обработчик истёкших вместе с другими
+            channel = await get_channel()
+            await channel.default_exchange.publish(copy_message(message), routing_key=TASK_EXPIRED_QUEUE)
+            return
+
+        lease = None
         async with get_session_local()() as db_session:
             try:
+                # 1. Забираем задачу (WAITING -> InProgress), если у пользователя не слишком много задач в работе
+                claimed = await MLTaskCRUD.claim(
+                    db_session, task_id, user_id, settings.TASK_MAX_IN_FLIGHT_PER_USER,
+                    is_retry=bool((message.headers or {}).get(ATTEMPT_HEADER)),
+                    worker_id=WORKER_ID,
+                    lease_seconds=settings.TASK_LEASE_SECONDS
+                )
+                await db_session.commit()
+                # Сколько задача ждала (вместе с откладываниями)
+                queue_wait = (time.time_ns() - payload['enqueued_at_ns']) / 1e9
+                if not claimed:
+                    task = await MLTaskCRUD.get_by_id(db_session, task_id)
+                    if task is not None and task.status == TaskStatus.WAITING:
+                        await defer_task(message, user_id, queue_wait)
+                    elif task is not None and task.status == TaskStatus.CANCELLED:
+                        metrics.inc("task_skipped_cancelled")
+                        logger.info(f"Задача №{task_id} отменена пользователем, пропускаем")
+                    else:
+                        logger.info(f"Задача №{task_id} уже не ожидает выполнения, пропускаем")
+                    return
+
+                untrack_over_quota(user_id)
+
+                # Пока задача считается, продлеваем её аренду
+                lease = asyncio.create_task(keep_lease(task_id))
+
+                # По приоритетам видно, не страдают ли интерактивные запросы; по task_over_quota_wait_seconds -
+                # сколько ждут пользователи, упёршиеся в лимит задач в работе
+                metrics.observe("task_queue_wait_seconds", queue_wait, priority=priority)
+                started = time.perf_counter()
+
                 logger.info(f"Воркер начал работу над задачей №{task_id}")
                 logger.info(f"Текст для разбора: {user_text}")
 
-                # 1. Меняем статус на InProgress
-                await MLTaskCRUD.update_status(db_session, task_id, TaskStatus.IN_PROGRESS)
-                await db_session.commit()
-
                 #  имитация сбоя для тестирования работы функции refund
                 # if random.random() < 0.5:
                 #     logger.warning(f"Имитация сбоя для задачи {task_id}...")
                 #     trigger_error = 1 / 0
 
-                    # 2. Работа ML-модели: морфологический разбор
-                # Разбиваем текст на слова и очищаем от знаков препинания
-                words = [w.strip('.,!?-()":;').lower() for w in user_text.split()]
-                # задаем порядок вывода характеристик
-
-                analysis_results = []
-                for word in words:
-                    if not re.search(r'[a-zA-Zа-яА-ЯёЁ]', word):
-                        continue
-                    parses = morph.parse(word)
-                    if parses:
-                        p = parses[0]
-                        full_info = []
-
-                        for attr_name in ATTRIBUTES_ORDER:
-                            attr_value = getattr(p.tag, attr_name, None)
-                            if attr_value:
-                                # Ищем перевод в словаре, если нет - оставляем код
-                                label = RUS_LABELS.get(str(attr_value), str(attr_value))
-                                full_info.append(label)
-
-                        # Собираем результат для одного слова
-                        description = ", ".join(full_info)
-                        analysis_results.append(f"{p.word} ({description})")
-
-                # 3. Формируем финальную строку результата
-                prediction = " | ".join(analysis_results)
-
-                # результат работы
-                final_output = prediction
-
-                # 4. Сохраняем в БД статус Completed
-                await MLTaskCRUD.complete_task(db_session, task_id, final_output)
-                await db_session.commit()
+                # 2. Работа ML-модели. Одинаковые задачи, которые воркер держит одновременно,
+                # считаются один раз, а результат сохраняется всем одним UPDATE
+                text = normalize_text(user_text)
 
-                logger.info(f"Задача № {task_id} успешно завершена")
+                async def compute():
+                    # разбор в пуле со сроком TASK_TIMEOUT_SECONDS
+                    return await process_task.analysis_pool.run(analyze_text, text)
 
-            except Exception as e:
+                async def complete(task_ids: list[int], prediction: str):
+                    # 3. Сохраняем в БД статус Completed
+                    await MLTaskCRUD.complete_many(db_session, task_ids, prediction, WORKER_ID)
+                    await db_session.commit()
+
+                computed = await single_flight.run((payload['model_id'], text), task_id, compute, complete)
+
+                metrics.observe("task_latency_seconds", queue_wait + time.perf_counter() - started, priority=priority)
+                logger.info(
+                    f"Задача № {task_id} успешно завершена{'' if computed else ' (результат одинаковой задачи)'} "
+                    f"(приоритет {priority}, ожидание в очереди {queue_wait:.2f} с)"
+                )
+
+            except AnalysisTimeout as e:
                 await db_session.rollback()
-                logger.error(f" Критическая ошибка задачи {task_id}: {e}")
-                # Возвращаем деньги и меняем статус на FAILED
-                # Внутри refund создаст транзакцию REFUND и прибавит деньги к балансу
+                # Повтор того же текста снова упрётся в срок — сразу FAILED и возврат средств
+                metrics.inc("task_timeouts")
+                logger.error(f"Задача {task_id} прервана: {e}")
                 await MLTaskCRUD.refund(db_session, task_id, reason=str(e))
                 await db_session.commit()
-                # Не «поднимаем» ошибку выше (raise), чтобы RabbitMQ не пытался бесконечно переповторять эту задачу
+            except Exception as e:
+                await db_session.rollback()
+                # Повтор через очередь с задержкой или, если попытки кончились, возврат средств.
+                # Если и здесь ошибка, сообщение будет отклонено и попадёт в ml_tasks.dead (dead-letter очереди)
+                await handle_failure(message, db_session, task_id, e)
+            except asyncio.CancelledError:
+                # Воркер останавливается, не дождавшись задачи: возвращаем её в ожидание, а сообщение в очередь,
+                # чтобы её сразу взял другой воркер, а не reaper после истечения аренды
+                try:
+                    await db_session.rollback()
+                    if lease is not None:
+                        await MLTaskCRUD.release(db_session, task_id)
+                    await message.nack(requeue=True)
+                except Exception as e:
+                    logger.warning(f"Не удалось вернуть задачу {task_id} в очередь при остановке: {e}")
+                raise
+            finally:
+                if lease is not None:
+                    lease.cancel()
+
+
+async def log_metrics(interval: float):
+    """Периодически пишет в лог метрики воркера (у воркера нет HTTP-эндпоинта /metrics)"""
+    while True:
+        await asyncio.sleep(interval)
+        snapshot = metrics.snapshot()
+        for key, value in snapshot["observations"].items():
+            logger.info(f"{key}: count={value['count']} avg={value['avg']:.3f} max={value['max']:.3f}")
+        for key, value in snapshot["gauges"].items():
+            logger.info(f"{key}: {value:.3f}")
 
 
 async def main():
     settings = get_settings()
-    logger.info("Подключение к RabbitMQ...")
-    connection = await connect(settings.RABBITMQ_URL)
-    channel = await connection.channel()
+    # Общее подключение процесса (им же пользуются откладывание задач и инвалидации кэша)
+    channel = await get_channel()
+
+    # Несколько задач одновременно: пока одна считается, остальные забираются из БД,
+    # а одинаковые присоединяются к уже идущему расчёту
+    await channel.set_qos(prefetch_count=settings.WORKER_PREFETCH_COUNT)
 
-    # 1 задача за раз
-    await channel.set_qos(prefetch_count=1)
+    # Объявляем очередь (с теми же параметрами, что и API)
+    queue = await declare_task_queue(channel)
+    process_task.deferred_queues = await declare_deferred_queues(channel)
+    process_task.retry_queues = await declare_retry_queues(channel)
 
-    # Объявляем очередь (durable=True, чтобы не пропала при перезагрузке)
-    queue = await channel.declare_queue("ml_tasks", durable=True)
+    # Пул разбора со сроком на задачу; модель загружается до начала приёма задач
+    process_task.analysis_pool = AnalysisPool(settings.ANALYSIS_PROCESSES, settings.TASK_TIMEOUT_SECONDS)
+    await process_task.analysis_pool.run(load_model)
 
     #  no_ack=False - возврат задачи в очередь, если воркер упадет
-    await queue.consume(process_task, no_ack=False)
+    consumer_tag = await queue.consume(consume_task, no_ack=False)
+
+    # Истёкшие задачи — на отдельном канале: для пачки нужно много неподтверждённых сообщений
+    expired_tasks = ExpiredTasks(settings.TASK_EXPIRED_BATCH_SIZE)
+    expired_channel = await (await get_connection()).channel()
+    await expired_channel.set_qos(prefetch_count=settings.TASK_EXPIRED_BATCH_SIZE)
+    expired_queue = await declare_expired_queue(expired_channel)
+    expired_consumer_tag = await expired_queue.consume(expired_tasks.on_message, no_ack=False)
+    expired_task = asyncio.create_task(expired_tasks.run(settings.TASK_EXPIRED_FLUSH_SECONDS))
+
+    metrics_task = asyncio.create_task(log_metrics(settings.WORKER_METRICS_LOG_INTERVAL_SECONDS))
+    # Каждый воркер запускает reaper: задачу с истёкшей арендой заберёт только один из них
+    reaper_task = asyncio.create_task(run_reaper(settings.TASK_REAPER_INTERVAL_SECONDS))
+
+    # SIGTERM (docker stop, выкатка, уменьшение числа воркеров) и Ctrl+C — корректная остановка
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
 
     logger.info("Воркер запущен. Ожидание задач...")
-    await asyncio.Future()
+    await stop.wait()
+
+    # 1. Перестаём получать новые сообщения (basic.cancel); полученные, но не подтверждённые остаются за нами
+    logger.info(f"Остановка воркера: задач в работе {len(in_flight)}")
+    await queue.cancel(consumer_tag)
+    await expired_queue.cancel(expired_consumer_tag)
+
+    # 2. Дожидаемся задач в работе. Не успевшие за WORKER_SHUTDOWN_GRACE_SECONDS прерываются
+    # и возвращаются в очередь (см. process_task)
+    if in_flight:
+        _, pending = await asyncio.wait(set(in_flight), timeout=settings.WORKER_SHUTDOWN_GRACE_SECONDS)
+        if pending:
+            logger.warning(f"Задачи не завершились за {settings.WORKER_SHUTDOWN_GRACE_SECONDS} с и возвращаются в очередь: {len(pending)}")
+            metrics.inc("worker_shutdown_requeued", len(pending))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    # 3. Записываем накопленное: возврат средств за истёкшие задачи из неполной пачки
+    await expired_tasks.flush()
+
+    # 4. Фоновые задачи и пул разбора
+    for task in (expired_task, metrics_task, reaper_task):
+        task.cancel()
+    await asyncio.gather(expired_task, metrics_task, reaper_task, return_exceptions=True)
+    process_task.analysis_pool.shutdown()
+
+    # 5. Закрываем подключения к брокеру и БД
+    await close_connection()
+    await get_engine().dispose()
+    logger.info("Воркер остановлен")
 
 
 if __name__ == "__main__":
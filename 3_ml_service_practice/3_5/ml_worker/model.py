@@ -0,0 +1,52 @@
+# =============================================
+# ML-модель воркера: морфологический разбор текста.
+# Вынесена в отдельный модуль, чтобы её можно было запускать в дочерних процессах пула разбора
+# =============================================
+import re
+import pymorphy3 # библиотека, которая выполняет роль ML-модели
+from ml_worker.dictionary import RUS_LABELS, ATTRIBUTES_ORDER
+
+# Анализатор загружается один раз на процесс (в пуле процессов - при старте дочернего процесса)
+morph = None
+
+
+def load_model():
+    """Инициализирует библиотеку, если она ещё не загружена в этом процессе"""
+    global morph
+    if morph is None:
+        morph = pymorphy3.MorphAnalyzer()
+
+
+def normalize_text(text: str) -> str:
+    """
+    Текст в том виде, в каком его разбирает модель: слова без знаков препинания по краям, в нижнем регистре.
+    Тексты с одинаковой нормализованной формой дают одинаковый результат.
+    """
+    return " ".join(w.strip('.,!?-()":;').lower() for w in text.split())
+
+
+def analyze_text(text: str) -> str:
+    """Морфологический разбор нормализованного текста (normalize_text)"""
+    load_model()
+    analysis_results = []
+    for word in text.split():
+        if not re.search(r'[a-zA-Zа-яА-ЯёЁ]', word):
+            continue
+        parses = morph.parse(word)
+        if parses:
+            p = parses[0]
+            full_info = []
+
+            for attr_name in ATTRIBUTES_ORDER:
+                attr_value = getattr(p.tag, attr_name, None)
+                if attr_value:
+                    # Ищем перевод в словаре, если нет - оставляем код
+                    label = RUS_LABELS.get(str(attr_value), str(attr_value))
+                    full_info.append(label)
+
+            # Собираем результат для одного слова
+            description = ", ".join(full_info)
+            analysis_results.append(f"{p.word} ({description})")
+
+    # Формируем финальную строку результата
+    return " | ".join(analysis_results)
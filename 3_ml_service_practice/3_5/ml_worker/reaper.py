@@ -0,0 +1,60 @@
+# =============================================
+# Reaper: возвращает в очередь или закрывает с возвратом средств задачи,
+# аренда которых истекла (воркер умер или завис посреди задачи)
+# =============================================
+import asyncio
+import logging
+from datetime import datetime
+from app.broker import publish_task, get_task_priority
+from app.crud.ml_task import MLTaskCRUD
+from app.crud.ml_model import MLModelCRUD
+from database.database import get_session_local
+from metrics import metrics
+from config import get_settings
+
+logger = logging.getLogger("uvicorn.error")
+
+ABANDONED_REASON = "Воркер не завершил задачу"
+
+
+async def reap_expired_leases():
+    """
+    Один проход: брошенные задачи одним UPDATE возвращаются в WAITING и публикуются заново
+    с приоритетом по автору и тексту и с прежним сроком (SLA от создания задачи), а задачи, которые уже забирали TASK_MAX_RECLAIMS раз, закрываются с возвратом средств.
+    """
+    settings = get_settings()
+    async with get_session_local()() as db_session:
+        requeued, exhausted = await MLTaskCRUD.reclaim_expired_leases(db_session, settings.TASK_MAX_RECLAIMS)
+        now = datetime.now()
+        for task in requeued:
+            ml_model = await MLModelCRUD.get_cached(db_session, task.model_id)
+            # явно пониженный клиентом приоритет не хранится, поэтому берётся приоритет по умолчанию
+            await publish_task(
+                task.task_id, task.input_data, task.model_id,
+                priority=get_task_priority(task.input_data, task.role),
+                user_id=task.user_id,
+                sla_seconds=ml_model.sla_seconds if ml_model else None,
+                created_at=task.created_at
+            )
+            metrics.inc("task_reclaimed")
+            # Время восстановления: от истечения аренды до возврата задачи в очередь
+            metrics.observe("task_lease_recovery_seconds", (now - task.lease_expires_at).total_seconds())
+        await db_session.commit()
+
+        refunded = 0
+        if exhausted:
+            refunded = await MLTaskCRUD.refund_many(db_session, exhausted, ABANDONED_REASON)
+            metrics.inc("task_reclaim_refunded", refunded)
+
+    if requeued or refunded:
+        logger.warning(f"Брошенные задачи: возвращено в очередь {len(requeued)}, закрыто с возвратом средств {refunded}")
+
+
+async def run_reaper(interval: float):
+    """Периодически запускает reap_expired_leases"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reap_expired_leases()
+        except Exception as e:
+            logger.error(f"Ошибка reaper: {e}")
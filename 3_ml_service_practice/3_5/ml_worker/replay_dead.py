@@ -0,0 +1,78 @@
+# =============================================
+# Перезапуск задач из очереди окончательно упавших (ml_tasks.dead)
+# =============================================
+import argparse
+import asyncio
+import os
+import sys
+sys.path.append(os.getcwd())
+from app.broker import get_channel, copy_message, close_connection, declare_task_queue, declare_retry_queues, TASK_DEAD_QUEUE, TASK_QUEUE, ATTEMPT_HEADER
+from app.crud.ml_task import MLTaskCRUD
+from app.task_payload import decode_task_payload
+from database.database import get_session_local
+import logging
+# необходим импорт моделей, чтобы SQLAlchemy знал о связях (Relationship)
+from app.models.user import User
+from app.models.balance import Balance
+from app.models.ml_task import MLTask
+from app.models.ml_model import MLModel
+from app.models.transaction import Transaction
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("replay_dead")
+
+
+async def replay(limit: int | None):
+    """
+    Забирает сообщения из ml_tasks.dead и возвращает задачи в ml_tasks с обнулённым счётчиком попыток.
+    Задачи, за которые уже вернули деньги, списываются повторно. Задачи, которые перезапустить нельзя
+    (выполнены, отменены пользователем, удалены, не хватает средств), остаются в ml_tasks.dead.
+    """
+    channel = await get_channel()
+    await declare_task_queue(channel)
+    await declare_retry_queues(channel)
+    dead_queue = await channel.get_queue(TASK_DEAD_QUEUE)
+
+    replayed, skipped = 0, []
+    while limit is None or replayed + len(skipped) < limit:
+        message = await dead_queue.get(no_ack=False, fail=False)
+        if message is None:
+            break
+        task_id = decode_task_payload(message.body, message.content_type)["task_id"]
+        async with get_session_local()() as db_session:
+            ok = await MLTaskCRUD.requeue(db_session, task_id)
+        if not ok:
+            logger.warning(f"Задачу №{task_id} перезапустить нельзя, оставляем в {TASK_DEAD_QUEUE}")
+            skipped.append(message)
+            continue
+        headers = {key: value for key, value in (message.headers or {}).items() if key != "x-error"}
+        headers[ATTEMPT_HEADER] = 0
+        await channel.default_exchange.publish(copy_message(message, headers), routing_key=TASK_QUEUE)
+        await message.ack()
+        replayed += 1
+
+    # Пропущенные сообщения возвращаем в очередь только в конце, иначе get() выдавал бы их снова
+    for message in skipped:
+        await message.nack(requeue=True)
+    logger.info(f"Перезапущено задач: {replayed}, оставлено в {TASK_DEAD_QUEUE}: {len(skipped)}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Перезапуск задач из ml_tasks.dead")
+    parser.add_argument("--limit", type=int, default=None, help="сколько сообщений обработать (по умолчанию все)")
+    args = parser.parse_args()
+    try:
+        await replay(args.limit)
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
+
+#  команда для запуска:
+# python -m ml_worker.replay_dead --limit 100
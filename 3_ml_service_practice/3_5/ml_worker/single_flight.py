@@ -0,0 +1,63 @@
+# =============================================
+# Объединение одинаковых задач, которые воркер считает одновременно (single-flight):
+# одна задача считает, остальные ждут её результат
+# =============================================
+import asyncio
+from metrics import metrics
+
+
+class SingleFlight:
+    """
+    Реестр расчётов, идущих сейчас в воркере, по ключу (model_id, нормализованный текст).
+    Первая задача с ключом (ведущая) выполняет расчёт и сохраняет результат сразу для себя и всех задач,
+    присоединившихся за время расчёта, - одним UPDATE. Остальные только ждут сохранения.
+    Деньги списываются за каждую задачу отдельно при создании, поэтому объединение на оплату не влияет.
+    """
+    def __init__(self):
+        self._flights = {}  # ключ -> (future завершения, task_id присоединившихся задач)
+
+    async def run(self, key, task_id: int, compute, complete) -> bool:
+        """
+        compute() - корутина расчёта, complete(task_ids, result) - сохранение результата всех задач.
+        Возвращает True, если задача считала сама, и False, если получила результат другой задачи.
+        Ошибка расчёта или сохранения передаётся всем задачам: каждая повторяется по своим попыткам.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight[1].append(task_id)
+            metrics.inc("task_coalesced")
+            # shield: отмена одной ждущей задачи не должна отменять общий результат для остальных
+            await asyncio.shield(flight[0])
+            return False
+
+        done = asyncio.get_running_loop().create_future()
+        followers = []
+        self._flights[key] = (done, followers)
+        try:
+            result = await compute()
+        except BaseException as e:
+            self._finish(key, done, followers, e)
+            raise
+        # Снимаем расчёт с регистрации до сохранения: задачи, пришедшие позже, в UPDATE уже не попадут
+        del self._flights[key]
+        try:
+            await complete([task_id, *followers], result)
+        except BaseException as e:
+            self._finish(None, done, followers, e)
+            raise
+        done.set_result(None)
+        if followers:
+            metrics.observe("task_coalesced_batch_size", len(followers) + 1)
+        return True
+
+    def _finish(self, key, done, followers: list, error: BaseException):
+        if key is not None:
+            del self._flights[key]
+        # без ждущих задач исключение некому забрать — не оставляем его в future
+        if not followers:
+            done.cancel()
+            return
+        # отмену ведущей задачи (остановка воркера) ждущие получают как обычную ошибку, чтобы ушли на повтор
+        if not isinstance(error, Exception):
+            error = RuntimeError("Расчёт одинаковой задачи прерван")
+        done.set_exception(error)
@@ -0,0 +1,200 @@
+# =============================================
+# Супервизор ML-воркеров: держит N процессов воркера, где N зависит от очереди задач.
+# Сигналы и расчёт числа воркеров можно использовать и без супервизора (например, из скрипта
+# масштабирования контейнеров): get_scaling_signals() и compute_desired_workers()
+# =============================================
+import argparse
+import asyncio
+import math
+import os
+import signal
+import sys
+import time
+sys.path.append(os.getcwd())
+from datetime import datetime
+from app.broker import close_connection, get_task_queue_stats
+from app.crud.ml_task import MLTaskCRUD
+from database.database import get_session_local, get_engine
+import logging
+from config import get_settings
+# необходим импорт моделей, чтобы SQLAlchemy знал о связях (Relationship)
+from app.models.user import User
+from app.models.balance import Balance
+from app.models.ml_task import MLTask
+from app.models.ml_model import MLModel
+from app.models.transaction import Transaction
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("supervisor")
+
+
+async def get_scaling_signals() -> dict:
+    """
+    Сигналы для масштабирования:
+    - queue_depth - сообщений в очереди ml_tasks;
+    - consumers - подключённых воркеров;
+    - in_progress - задач в работе (по БД);
+    - oldest_wait_seconds - сколько ждёт самая старая задача в статусе WAITING (0, если таких нет).
+    """
+    queue_depth, consumers = await get_task_queue_stats()
+    async with get_session_local()() as db_session:
+        oldest_waiting, in_progress = await MLTaskCRUD.get_backlog_stats(db_session)
+    return {
+        "queue_depth": queue_depth,
+        "consumers": consumers,
+        "in_progress": in_progress,
+        "oldest_wait_seconds": (datetime.now() - oldest_waiting).total_seconds() if oldest_waiting else 0.0
+    }
+
+
+def compute_desired_workers(current: int, signals: dict, settings=None) -> int:
+    """
+    Сколько воркеров нужно при текущих сигналах (get_scaling_signals), в пределах
+    WORKER_AUTOSCALE_MIN..WORKER_AUTOSCALE_MAX. Без побочных эффектов.
+
+    Увеличение - сразу, как только очередь не разбирается за WORKER_AUTOSCALE_TARGET_WAIT_SECONDS:
+    воркеров столько, чтобы очередь разобралась за это время (ADMISSION_TASK_SECONDS на задачу),
+    и хотя бы на одного больше, если самая старая задача ждёт дольше.
+    Уменьшение - по одному и только при пустой очереди и загрузке воркеров ниже
+    WORKER_AUTOSCALE_DOWN_UTILIZATION. Пороги увеличения и уменьшения разные (гистерезис),
+    поэтому на границе число воркеров не колеблется; паузу между изменениями выдерживает вызывающий.
+    """
+    settings = settings or get_settings()
+    depth = signals["queue_depth"]
+    needed = math.ceil(depth * settings.ADMISSION_TASK_SECONDS / settings.WORKER_AUTOSCALE_TARGET_WAIT_SECONDS)
+    if depth > 0 and signals["oldest_wait_seconds"] > settings.WORKER_AUTOSCALE_TARGET_WAIT_SECONDS:
+        needed = max(needed, current + 1)
+
+    if needed > current:
+        desired = needed
+    else:
+        # загрузка: задачи в работе на все слоты разбора всех подключённых воркеров
+        slots = max(signals["consumers"] or current, 1) * max(settings.ANALYSIS_PROCESSES, 1)
+        utilization = signals["in_progress"] / slots
+        if depth == 0 and utilization < settings.WORKER_AUTOSCALE_DOWN_UTILIZATION:
+            desired = current - 1
+        else:
+            desired = current
+    return max(settings.WORKER_AUTOSCALE_MIN, min(settings.WORKER_AUTOSCALE_MAX, desired))
+
+
+class Supervisor:
+    """
+    Запускает воркеры (python -m ml_worker.main) дочерними процессами и раз в
+    WORKER_AUTOSCALE_INTERVAL_SECONDS приводит их число к compute_desired_workers.
+    Лишние воркеры останавливаются по SIGTERM и успевают доделать задачи; упавшие запускаются заново.
+    """
+    def __init__(self):
+        self.settings = get_settings()
+        self.workers = []  # работающие процессы, последний - самый новый
+        self._stopping = set()  # процессы, которым отправлен SIGTERM
+        self._stop_tasks = set()  # фоновые остановки (stop_worker): ссылки держим, иначе задачу может собрать GC
+        self._last_change = 0.0  # время последнего изменения числа воркеров (time.monotonic)
+
+    async def start_worker(self):
+        process = await asyncio.create_subprocess_exec(sys.executable, "-m", "ml_worker.main")
+        self.workers.append(process)
+        logger.info(f"Запущен воркер pid={process.pid}, воркеров: {len(self.workers)}")
+
+    async def _terminate(self, process):
+        """SIGTERM и ожидание остановки; не успевший за период остановки воркер убивается"""
+        self._stopping.add(process)
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), timeout=self.settings.WORKER_SHUTDOWN_GRACE_SECONDS + 5)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            logger.warning(f"Воркер pid={process.pid} не остановился вовремя, завершаем принудительно")
+            process.kill()
+            await process.wait()
+        finally:
+            self._stopping.discard(process)
+
+    def stop_worker(self):
+        """Останавливает самый новый воркер (в фоне, не дожидаясь завершения его задач)"""
+        process = self.workers.pop()
+        task = asyncio.create_task(self._terminate(process))
+        self._stop_tasks.add(task)
+        task.add_done_callback(self._stop_tasks.discard)
+        logger.info(f"Останавливается воркер pid={process.pid}, воркеров: {len(self.workers)}")
+
+    def _drop_exited(self):
+        for process in [p for p in self.workers if p.returncode is not None]:
+            self.workers.remove(process)
+            logger.error(f"Воркер pid={process.pid} завершился с кодом {process.returncode}")
+
+    async def scale(self):
+        """Один шаг: убирает упавшие процессы и приводит число воркеров к нужному"""
+        self._drop_exited()
+        current = len(self.workers)
+        try:
+            signals = await get_scaling_signals()
+            desired = compute_desired_workers(current, signals, self.settings)
+        except Exception as e:
+            # без сигналов число воркеров не меняем, только восстанавливаем упавшие до минимума
+            logger.warning(f"Не удалось получить сигналы масштабирования: {e}")
+            signals, desired = None, max(current, self.settings.WORKER_AUTOSCALE_MIN)
+
+        cooldown_passed = time.monotonic() - self._last_change >= self.settings.WORKER_AUTOSCALE_DOWN_COOLDOWN_SECONDS
+        if desired > current:
+            for _ in range(desired - current):
+                await self.start_worker()
+        elif desired < current and cooldown_passed:
+            self.stop_worker()
+        else:
+            return
+        self._last_change = time.monotonic()
+        logger.info(f"Воркеров: {current} -> {len(self.workers)}, сигналы: {signals}")
+
+    async def run(self, stop: asyncio.Event):
+        for _ in range(self.settings.WORKER_AUTOSCALE_MIN):
+            await self.start_worker()
+        self._last_change = time.monotonic()
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.settings.WORKER_AUTOSCALE_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                await self.scale()
+
+        # Останавливаем все воркеры одновременно, каждый доделывает свои задачи
+        logger.info(f"Остановка супервизора, воркеров: {len(self.workers)}")
+        workers, self.workers = self.workers, []
+        await asyncio.gather(*(self._terminate(p) for p in workers), *list(self._stop_tasks))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Супервизор ML-воркеров с автомасштабированием")
+    parser.add_argument(
+        "--recommend", type=int, metavar="CURRENT", default=None,
+        help="не запускать воркеры, а вывести сигналы и нужное число воркеров при CURRENT текущих"
+    )
+    args = parser.parse_args()
+    try:
+        if args.recommend is not None:
+            signals = await get_scaling_signals()
+            print(signals)
+            print(compute_desired_workers(args.recommend, signals))
+            return
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        await Supervisor().run(stop)
+    finally:
+        await close_connection()
+        await get_engine().dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
+
+#  команда для запуска супервизора (вместо docker-compose up --scale ml_worker=N):
+# python -m ml_worker.supervisor
+#  нужное число воркеров для внешнего масштабирования (например, из cron или оркестратора):
+# python -m ml_worker.supervisor --recommend 2
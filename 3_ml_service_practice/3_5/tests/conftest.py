@@ -0,0 +1,124 @@
+# =============================================
+# Общие фикстуры тестов: приложение на SQLite (aiosqlite) без брокера
+# =============================================
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+from decimal import Decimal
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Настройки, без которых не создаётся Settings; значения для подключения к Postgres и RabbitMQ не используются
+for _key, _value in {
+    "APP_NAME": "ml-service-test", "API_VERSION": "test",
+    "DB_HOST": "localhost", "DB_PORT": "5432", "DB_USER": "test", "DB_PASS": "test", "DB_NAME": "test",
+    "RABBITMQ_USER": "test", "RABBITMQ_PASS": "test", "RABBITMQ_HOST": "localhost", "RABBITMQ_PORT": "5672",
+    "SECRET_KEY": "test-secret", "ALGORITHM": "HS256", "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    "RATE_LIMIT_ENABLED": "False", "DEBUG": "False"
+}.items():
+    os.environ.setdefault(_key, _value)
+
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine
+from app.api import app
+from app.admission import admission_control
+from app.auth.access_token import create_token, ACCESS_TOKEN_COOKIE
+from app.crud import cache
+from app.models.user import User
+from app.models.balance import Balance
+from app.models.ml_model import MLModel
+from app.models.enums import UserRole
+import app.routers.ml_task as ml_task_router
+import database.database as database
+from database.database import mapper_registry, INTERACTIVE_POOL, EXPORT_POOL
+from database.instrumentation import instrument_engine
+
+
+class _Exchange:
+    """Обменник инвалидаций кэша без брокера"""
+    async def publish(self, *args, **kwargs):
+        pass
+
+
+async def _get_exchange():
+    return _Exchange()
+
+
+@asynccontextmanager
+async def _no_lifespan(app):
+    # без init_db, прогрева пула и подписки на RabbitMQ
+    yield
+
+
+@pytest.fixture
+def published(monkeypatch):
+    """Задачи, отправленные в очередь (вместо публикации в RabbitMQ)"""
+    tasks = []
+
+    async def publish_task(task_id, *args, **kwargs):
+        tasks.append(task_id)
+
+    monkeypatch.setattr(ml_task_router, "publish_task", publish_task)
+    return tasks
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """
+    Движок SQLite с теми же обработчиками событий, что и у боевого: подменяет движки пулов,
+    реплика не настроена. Кэши процесса очищаются, чтобы запросы считались с холодного старта.
+    """
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+    instrument_engine(engine, name="test")
+
+    async def create_schema():
+        async with engine.begin() as conn:
+            await conn.run_sync(mapper_registry.metadata.create_all)
+        await engine.dispose()
+
+    asyncio.run(create_schema())
+    monkeypatch.setattr(database.get_engine, "_engines", {INTERACTIVE_POOL: engine, EXPORT_POOL: engine}, raising=False)
+    monkeypatch.setattr(database.get_replica_engine, "_engines", {INTERACTIVE_POOL: None, EXPORT_POOL: None}, raising=False)
+    monkeypatch.delattr(database.get_session_local, "_sessionmaker", raising=False)
+    monkeypatch.setattr(cache, "_get_exchange", _get_exchange)
+    for ttl_cache in cache._caches.values():
+        ttl_cache.clear()
+    yield engine
+    asyncio.run(engine.dispose())
+
+
+@pytest.fixture
+def client(db, published, monkeypatch):
+    """TestClient без lifespan и без контроля очереди (он спрашивает длину очереди у RabbitMQ)"""
+    monkeypatch.setattr(app.router, "lifespan_context", _no_lifespan)
+    app.dependency_overrides[admission_control] = lambda: None
+    with TestClient(app) as test_client:
+        yield test_client
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def user(db):
+    """Пользователь с балансом и ML-модель; возвращается пользователь (ORM-объект)"""
+    async def seed():
+        async with database.get_session_local()() as db_session:
+            user = User(user_name="test", email="test@example.com", password_hash="x", role=UserRole.USER)
+            db_session.add(user)
+            await db_session.flush()
+            db_session.add(Balance(user_id=user.user_id, amount=Decimal("100.00")))
+            db_session.add(MLModel(model_name="test", cost_per_prediction=Decimal("5.00")))
+            await db_session.commit()
+            return user
+
+    user = asyncio.run(seed())
+    asyncio.run(db.dispose())
+    return user
+
+
+@pytest.fixture
+def auth_client(client, user):
+    """Клиент, авторизованный access-токеном пользователя user"""
+    client.cookies.set(ACCESS_TOKEN_COOKIE, create_token(user))
+    return client
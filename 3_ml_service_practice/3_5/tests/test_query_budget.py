@@ -0,0 +1,45 @@
+# =============================================
+# Бюджеты SQL-запросов на эндпоинты: рост числа запросов (N+1) роняет тест
+# =============================================
+from fastapi.responses import HTMLResponse
+from database.instrumentation import assert_query_budget
+import app.routers.web as web
+
+
+def test_get_current_user_budget(auth_client):
+    # авторизация по токену: только версия токенов (и то при промахе кэша), без чтения пользователя
+    with assert_query_budget(2):
+        response = auth_client.get("/users/api_keys")
+    assert response.status_code == 200
+
+    # версия токенов уже в кэше: остаётся один запрос самого эндпоинта
+    with assert_query_budget(1):
+        response = auth_client.get("/users/api_keys")
+    assert response.status_code == 200
+
+
+def test_predict_budget(auth_client, published):
+    # версия токенов, каталог моделей (холодный кэш), баланс, списание, задача, транзакция, refresh задачи
+    with assert_query_budget(7):
+        response = auth_client.post("/ml_task/predict", json={"input_data": "Мама мыла раму"})
+    assert response.status_code == 200
+    assert published == [response.json()["task_id"]]
+
+
+def test_web_predict_error_path_budget(auth_client, published, monkeypatch):
+    # считаем только запросы обработчика: шаблон подменён и получает лишь контекст страницы
+    rendered = {}
+
+    def template_response(name, context, *args, **kwargs):
+        rendered.update(context, template=name)
+        return HTMLResponse("")
+
+    monkeypatch.setattr(web.templates, "TemplateResponse", template_response)
+
+    # текст без букв не проходит валидацию: страница профиля строится заново - версия токенов,
+    # каталог моделей, история и баланс (кэши холодные), без повторного чтения модели и баланса из БД
+    with assert_query_budget(4):
+        response = auth_client.post("/profile/predict", data={"input_text": "12345"})
+    assert response.status_code == 200
+    assert rendered["template"] == "profile.html" and rendered["error"]
+    assert published == []